@@ -0,0 +1,209 @@
+from __future__ import print_function
+import os
+import fnmatch
+import sqlite3
+import multiprocessing
+from astropy.table import Table
+
+from .Raw import Ddata
+
+# columns of the catalogue table, and their SQL types
+COLUMNS = (
+    ('path', 'TEXT PRIMARY KEY'),
+    ('night', 'TEXT'),
+    ('run', 'TEXT'),
+    ('size', 'INTEGER'),
+    ('mtime', 'REAL'),
+    ('xml_size', 'INTEGER'),
+    ('xml_mtime', 'REAL'),
+    ('instrument', 'TEXT'),
+    ('object', 'TEXT'),
+    ('format', 'INTEGER'),
+    ('xbin', 'INTEGER'),
+    ('ybin', 'INTEGER'),
+    ('nx', 'INTEGER'),
+    ('ny', 'INTEGER'),
+    ('numexp', 'INTEGER'),
+    ('exposeTime', 'REAL'),
+    ('tstart', 'REAL'),
+    ('tend', 'REAL'),
+    ('error', 'TEXT'),
+)
+
+
+def _stamp(path):
+    """Size and modification time of a run's .dcimg file, and those of its
+    .xml file"""
+    st = os.stat(path)
+    xml = os.path.splitext(path)[0] + '.xml'
+    if os.path.exists(xml):
+        xml_st = os.stat(xml)
+        return st.st_size, st.st_mtime, xml_st.st_size, xml_st.st_mtime
+    return st.st_size, st.st_mtime, None, None
+
+
+def _changed(path, stamp):
+    """True if the run at path no longer has the given stamp"""
+    try:
+        return _stamp(path) != stamp
+    except OSError:
+        # gone since it was found; let scan_run record the error
+        return True
+
+
+def scan_run(path):
+    """
+    Reads the catalogue entry for one run.
+
+    Only the binary header, the XML metadata and the timestamps of the first
+    and last frames are read. If the run cannot be read, the entry records
+    the error instead.
+
+    Parameters
+    ----------
+    path : str
+        path to the .dcimg file of the run.
+
+    Returns
+    -------
+    row : dict
+        values of the catalogue columns for the run.
+    """
+    path = os.path.abspath(path)
+    row = dict((name, None) for name, sqltype in COLUMNS)
+    row['path'] = path
+    row['night'] = os.path.basename(os.path.dirname(path))
+    row['run'] = os.path.splitext(os.path.basename(path))[0]
+    try:
+        row['size'], row['mtime'], row['xml_size'], row['xml_mtime'] = _stamp(path)
+        ddat = Ddata(os.path.splitext(path)[0])
+        row.update(instrument=ddat.instrument, object=ddat.user['object'],
+                   format=ddat.format, xbin=ddat.xbin, ybin=ddat.ybin,
+                   nx=ddat.nx, ny=ddat.ny, numexp=ddat.numexp,
+                   exposeTime=ddat.exposeTime)
+        if ddat.numexp > 0:
+            row['tstart'] = ddat._read_unix_time(1)
+            row['tend'] = ddat._read_unix_time(ddat.numexp)
+    except Exception as err:
+        row['error'] = '{}: {}'.format(type(err).__name__, err)
+    return row
+
+
+def find_runs(dirs, pattern='run*.dcimg'):
+    """Returns the paths of all runs in, or below, the directories dirs"""
+    paths = []
+    for top in dirs:
+        for dirpath, dirnames, filenames in os.walk(top):
+            paths.extend(os.path.abspath(os.path.join(dirpath, filename))
+                         for filename in fnmatch.filter(filenames, pattern))
+    return sorted(paths)
+
+
+def _connect(dbfile):
+    conn = sqlite3.connect(dbfile)
+    conn.execute('CREATE TABLE IF NOT EXISTS runs ({})'.format(
+                 ', '.join('{} {}'.format(name, sqltype) for name, sqltype in COLUMNS)))
+    # bring catalogues made by older versions up to date. Their runs have
+    # NULL in the new columns, so are all read again on the next build
+    present = set(row[1] for row in conn.execute('PRAGMA table_info(runs)'))
+    for name, sqltype in COLUMNS:
+        if name not in present:
+            conn.execute('ALTER TABLE runs ADD COLUMN {} {}'.format(name, sqltype))
+    return conn
+
+
+def build_catalogue(dirs, dbfile, workers=None, pattern='run*.dcimg', rescan=False):
+    """
+    Builds, or brings up to date, a catalogue of all the runs in a set of
+    directories.
+
+    The catalogue is the table 'runs' in an SQLite database, with the columns
+    listed in COLUMNS, so it can be queried directly with SQL or read with
+    :func:`read_catalogue`. Runs already in the catalogue are only read again
+    if their .dcimg or .xml file has changed, and runs that have disappeared
+    from the directories are removed. New and changed runs are read in
+    parallel by a pool of processes.
+
+    Parameters
+    ----------
+    dirs : list of str
+        directories to search, including their subdirectories.
+    dbfile : str
+        SQLite database file to hold the catalogue. Created if it does not
+        exist.
+    workers : int
+        number of worker processes. Defaults to the number of CPUs.
+    pattern : str
+        pattern matched by the names of .dcimg files of runs.
+    rescan : bool
+        True to read every run again, whether or not it has changed.
+
+    Returns
+    -------
+    nscanned, nremoved : int
+        number of runs read, and number removed from the catalogue.
+    """
+    paths = find_runs(dirs, pattern)
+    tops = [os.path.join(os.path.abspath(top), '') for top in dirs]
+    conn = _connect(dbfile)
+    try:
+        known = dict((row[0], tuple(row[1:])) for row in
+                     conn.execute('SELECT path, size, mtime, xml_size, xml_mtime FROM runs'))
+
+        # forget runs under the scanned directories that no longer exist
+        current = set(paths)
+        gone = [path for path in known
+                if path not in current and any(path.startswith(top) for top in tops)]
+        conn.executemany('DELETE FROM runs WHERE path = ?', [(path,) for path in gone])
+
+        todo = [path for path in paths
+                if rescan or path not in known or _changed(path, known[path])]
+        names = [name for name, sqltype in COLUMNS]
+        sql = 'INSERT OR REPLACE INTO runs ({}) VALUES ({})'.format(
+              ', '.join(names), ', '.join('?'*len(names)))
+        if todo:
+            pool = multiprocessing.Pool(workers)
+            try:
+                for row in pool.imap_unordered(scan_run, todo, chunksize=4):
+                    conn.execute(sql, [row[name] for name in names])
+            finally:
+                pool.close()
+                pool.join()
+        conn.commit()
+    finally:
+        conn.close()
+    return len(todo), len(gone)
+
+
+def read_catalogue(dbfile, where=None, params=()):
+    """
+    Reads a catalogue made by :func:`build_catalogue` into an astropy Table.
+
+    Parameters
+    ----------
+    dbfile : str
+        SQLite database file holding the catalogue.
+    where : str
+        optional SQL condition selecting the runs to read, e.g.
+        "night = ? AND numexp > 100".
+    params : tuple
+        values for any ? placeholders in where.
+
+    Returns
+    -------
+    table : astropy.table.Table
+        one row per run, sorted by path.
+    """
+    names = [name for name, sqltype in COLUMNS]
+    sql = 'SELECT {} FROM runs'.format(', '.join(names))
+    if where is not None:
+        sql += ' WHERE ' + where
+    sql += ' ORDER BY path'
+    conn = _connect(dbfile)
+    try:
+        rows = conn.execute(sql, params).fetchall()
+    finally:
+        conn.close()
+    if not rows:
+        return Table(names=names)
+    return Table(rows=rows, names=names)
@@ -1,9 +1,16 @@
 from __future__ import print_function
 import numpy as np
+import collections
 from math import floor, log10
 import os
+import json
+import struct
+from functools import reduce
+import multiprocessing
 from astropy.time import Time
 import six
+from six.moves import queue
+import threading
 import warnings
 
 # labview XML parsing
@@ -20,6 +27,12 @@ except:
     useTRM = False
 
 
+# positional reads, which do not use or move the file position, let one
+# open file serve many threads. Fall back to seek and read under a lock.
+_HAVE_PREADV = hasattr(os, 'preadv')
+_HAVE_PREAD = hasattr(os, 'pread')
+
+
 def from_bytes(data, byteorder='little'):
     if six.PY3:
         return int.from_bytes(data, byteorder)
@@ -42,6 +55,202 @@ class DendError(Exception):
     pass
 
 
+class HeaderLayout(object):
+    """Describes where the metadata are stored in the binary header of one
+    variety of DCIMG file.
+
+    All fields are decoded with a single :meth:`struct.Struct.unpack_from`
+    call. To support a new variety of DCIMG file, create a layout for it and
+    add it with :func:`register_header_layout`.
+
+    Parameters
+    ----------
+    name : str
+        name of the layout.
+
+    format : int
+        DCIMG format number, for information. 0 for the old format, with
+        timestamps in a footer, and 1 for the new format, with extra info
+        after each frame.
+
+    hdr_length : int
+        number of bytes in the header, before the first frame.
+
+    fields : list of tuples
+        (name, offset, code, transform) for each field, where code is a
+        :mod:`struct` format character, e.g. 'I' for a 4 byte unsigned int,
+        and transform is None or a function applied to the decoded value.
+        Values are little-endian and fields must not overlap.
+
+    probe : callable
+        called with the dictionary of decoded fields, returns True if the
+        header is of this variety.
+
+    derive : callable
+        called with the dictionary of decoded fields and the header bytes
+        once the probe has succeeded, to add any fields that cannot be read
+        directly. May be None.
+
+    instruments : tuple of str
+        instruments the layout applies to, or None for any instrument.
+
+    trailer_size : int
+        number of bytes of extra info that follow each frame.
+
+    trailer_time_offset : int
+        offset within the extra info after each frame of its timestamp, or
+        None if the timestamps are in a table elsewhere in the file.
+
+    The dictionary of fields must end up containing 'nframes', 'bitdepth',
+    'xsize', 'ysize', 'bytes_per_img' and 'binning'. Layouts without
+    timestamps after each frame also need 'time_table', the byte offset of
+    the table of timestamps. Each timestamp is 8 bytes, as decoded by
+    :meth:`Ddata._decode_float`.
+    """
+    def __init__(self, name, format, hdr_length, fields, probe, derive=None, instruments=None,
+                 trailer_size=0, trailer_time_offset=None):
+        self.name = name
+        self.format = format
+        self.hdr_length = hdr_length
+        self.probe = probe
+        self.derive = derive
+        self.instruments = instruments
+        self.trailer_size = trailer_size
+        self.trailer_time_offset = trailer_time_offset
+        if trailer_time_offset is not None and trailer_time_offset + 8 > trailer_size:
+            raise ValueError('HeaderLayout {}: timestamp extends beyond trailer'.format(self.name))
+
+        # compile the fields into one struct, padding the gaps between them
+        fields = sorted(fields, key=lambda field: field[1])
+        fmt = '<'
+        pos = 0
+        for name, offset, code, transform in fields:
+            if offset < pos:
+                raise ValueError('HeaderLayout {}: field {} overlaps the one before'.format(
+                                 self.name, name))
+            if offset > pos:
+                fmt += '{}x'.format(offset-pos)
+            fmt += code
+            pos = offset + struct.calcsize('<' + code)
+        if pos > hdr_length:
+            raise ValueError('HeaderLayout {}: fields extend beyond header'.format(self.name))
+        self._struct = struct.Struct(fmt)
+        self._fields = [(name, transform) for name, offset, code, transform in fields]
+
+    def decode(self, hdr_bytes):
+        """Returns a dictionary of the fields decoded from hdr_bytes"""
+        header = {}
+        for (name, transform), value in zip(self._fields, self._struct.unpack_from(hdr_bytes)):
+            header[name] = value if transform is None else transform(value)
+        return header
+
+    def parse(self, hdr_bytes, instrument=None):
+        """Returns the dictionary of header fields if hdr_bytes is a header
+        of this variety, for the given instrument, or None if it is not."""
+        if self.instruments is not None and instrument not in self.instruments:
+            return None
+        if len(hdr_bytes) < self.hdr_length:
+            return None
+        header = self.decode(hdr_bytes)
+        if not self.probe(header):
+            return None
+        if self.derive is not None:
+            self.derive(header, hdr_bytes)
+        return header
+
+
+#: registered header layouts, in the order they are tried
+HEADER_LAYOUTS = []
+
+
+def register_header_layout(layout, first=False):
+    """Adds a :class:`HeaderLayout` to those tried when opening DCIMG files.
+
+    Layouts are tried in the order they are registered, unless first is
+    True, in which case the layout is tried before all the others."""
+    if first:
+        HEADER_LAYOUTS.insert(0, layout)
+    else:
+        HEADER_LAYOUTS.append(layout)
+
+
+def parse_header(hdr_bytes, instrument=None):
+    """Decodes the binary header of a DCIMG file.
+
+    Returns the first registered :class:`HeaderLayout` that matches, and the
+    dictionary of header fields. Raises a DcimgError if none matches."""
+    for layout in HEADER_LAYOUTS:
+        header = layout.parse(hdr_bytes, instrument)
+        if header is not None:
+            return layout, header
+    raise DcimgError('DCIMG format not recognised')
+
+
+# Since the DCIMG format is not documented, the layouts below are reverse
+# engineered and may be in error.
+
+def _consistent_sizes(header):
+    return (header['bytes_per_row'] > 0 and
+            header['bytes_per_img'] == header['bytes_per_row']*header['ysize'])
+
+
+def _derive_old(header, hdr_bytes):
+    # nframes follows a block whose length in 4 byte words is given at byte 8
+    header['nframes'] = struct.unpack_from('<I', hdr_bytes, 8 + 4*header['skip_words'])[0]
+    # if we requested an image of nx by ny pixels, then DCIMG files
+    # for the ORCA flash 4.0 still save the full array in x.
+    header['xsize'] = int(header['bytes_per_row']/2)
+    # this only works because MOSCAM always reads out 2048 pixels per row
+    # at least when connected via cameralink. This would fail on USB3 connection
+    # and probably for other cameras.
+    # TODO: find another way to work out binning
+    header['binning'] = int(4096/header['bytes_per_row'])
+    # funny entry pair which references footer location
+    header['footer_loc'] = header['footer_ptr'] + header['footer_offset']
+    # footer consists of 272 bytes of information I don't yet understand
+    # then nframes*4 bytes which are a record of the frame numbers
+    # then 8 bytes of timing info per frame
+    header['time_table'] = header['footer_loc'] + 272 + 4*header['nframes']
+
+
+def _derive_new(header, hdr_bytes):
+    header['xsize'] = int(header['bytes_per_row']/2)
+
+
+register_header_layout(HeaderLayout(
+    'MOSCAM old format', 0, 232,
+    [('skip_words', 8, 'I', None),
+     ('footer_offset', 40, 'I', None),
+     ('filesize', 48, 'I', None),
+     ('bitdepth', 156, 'I', lambda v: 8*v),
+     ('xsize_req', 164, 'I', None),
+     ('bytes_per_row', 168, 'I', None),
+     ('ysize', 172, 'I', None),
+     ('bytes_per_img', 176, 'I', None),
+     ('footer_ptr', 192, 'I', None)],
+    probe=lambda h: 8 + 4*h['skip_words'] + 4 <= 232 and _consistent_sizes(h),
+    derive=_derive_old,
+    instruments=('MOSCAM',)))
+
+register_header_layout(HeaderLayout(
+    'MOSCAM new format', 1, 864,
+    [('nframes', 36, 'I', None),
+     ('filesize', 48, 'I', None),
+     ('xsize_req', 184, 'I', None),
+     ('ysize', 188, 'I', None),
+     ('bytes_per_row', 192, 'I', None),
+     ('bytes_per_img', 196, 'I', None),
+     ('bitdepth', 236, 'I', lambda v: int(v/2)),
+     # TODO: find another way to work out binning
+     ('binning', 791, 'I', lambda v: int(v/16/16))],
+    probe=_consistent_sizes,
+    derive=_derive_new,
+    instruments=('MOSCAM',),
+    # each frame is followed by 32 bytes, with the timestamp in bytes 4-12
+    trailer_size=32,
+    trailer_time_offset=4))
+
+
 class Dhead(object):
     """Represents essential metadata info of MOSCAM data read from the
     run###.xml.
@@ -82,6 +291,10 @@ class Dhead(object):
         exposure delay, secs
 
     """
+    # names of the LabVIEW XML variables read by __init__
+    _xml_attrs = ("Exposure  (secs)", "Object", "Observer",
+                  "V Offset", "H Offset", "Camera Model")
+
     def __init__(self, run):
         if not run.endswith('.xml'):
             self.run = run
@@ -89,14 +302,16 @@ class Dhead(object):
         else:
             self.run = os.path.splitext(run)[0]
 
-        # read in Labview XML data
+        # read in just the Labview XML data we need, streaming the file
         LabviewXMLData = LabviewXMLDataLoader()
-        LabviewXMLData.loadXMLDataFile(run)
+        values = LabviewXMLData.streamXMLDataFile(run, self._xml_attrs)
 
         # now we can process XML data to populate attributes
         # below is a convenience function to make this easy
         def getXMLAttr(attrName):
-            structure = parseLVDataXML_ReturnValue(LabviewXMLData.XMLDocNode, attrName)
+            if attrName not in values:
+                raise DcimgError("No node with this name - '{}'".format(attrName))
+            structure = values[attrName]
             # if it's a structure, we want the "Val" attr
             try:
                 return structure['Val']
@@ -146,19 +361,33 @@ class Ddata(Dhead):
       for frm in Ddata('run045'):
          print 'nccd = ',frm.nccd()
 
-    Ddata maintains an internal file object that is always at the start of a
-    frame. This enables sequential reads to be swift. If an attempt is made
-    to access a frame that does not exist, it defaults to the start of the
-    file.
+    Ddata keeps track of the next frame to be read, but every read is made at
+    an explicit offset in the file rather than relative to a shared file
+    position. One Ddata can therefore be used by several threads at once,
+    provided each passes explicit frame numbers or uses its own iterator.
 
     The above code returns :class:`trm.ultracam.CCD` objects for MOSCAM data
     if Tom's module is installed, otherwise it returns a numpy data array.
+
+    Alternatively, the whole run can be memory mapped, in which case frames
+    are returned as read-only views onto the file without being copied::
+
+      ddat = Ddata('run045', mmap=True)
+      fr10 = ddat(10)
+      stack = ddat.memmap()['data']
     """
-    def __init__(self, run, nframe=1, flt=True):
+    # largest number of bytes read in one go when reading several frames
+    _max_read_bytes = 64*1024*1024
+
+    #: number of threads used for asynchronous reads
+    aio_workers = 4
+
+    def __init__(self, run, nframe=1, flt=True, mmap=False, dtype=None, bias=None, gain=None,
+                 sidecar=False):
         """Create Ddata object
 
         Connects to a raw dcimg file for reading. The file is kept open.
-        The file pointer is set to the start of frame nframe. The Ddata
+        The next frame to be read is set to nframe. The Ddata
         object can then generate CCD objects through being called
         as a function or iterator.
 
@@ -175,16 +404,55 @@ class Ddata(Dhead):
             in this form for speed and efficiency, then set flt=False.  This
             parameter is used when iterating through an Ddata. The __call__
             method can override it.
+        dtype : numpy dtype
+            dtype to return the data as. Overrides flt if set. Use e.g.
+            np.float32 to get floats in half the memory of the default
+            np.float64.
+        bias : float
+            if set, subtracted from the data whenever they are converted to
+            floats. The subtraction is done in place during conversion.
+        gain : float
+            if set, the data are multiplied by this whenever they are
+            converted to floats, after subtracting any bias.
+        mmap : bool
+            True to access frames through a read-only memory map of the
+            file rather than by reading them. Frames read as uint16 are
+            then views onto the file and are not copied.
+        sidecar : bool
+            True to keep the metadata of the run in a sidecar file next to
+            it, e.g. 'run026.dcimg.idx'. This holds the XML metadata, the
+            binary header and the timestamps of all frames, so that opening
+            the run again is quick. The sidecar is rebuilt if the run's
+            .dcimg or .xml file has changed size or modification time.
         """
 
-        # initialise header
-        super(Ddata, self).__init__(run)
+        # initialise header, from the sidecar if there is a valid one
+        meta = None
+        if sidecar:
+            self.run = os.path.splitext(run)[0] if run.endswith('.xml') else run
+            meta = self._load_sidecar()
+        if meta is None:
+            super(Ddata, self).__init__(run)
+        else:
+            for attr in self._sidecar_attrs:
+                setattr(self, attr, meta['head'][attr])
         # Attributes set are:
         #
         # _fobj   -- file object opened on data file (set to None if using server)
-        # _nf     -- next frame to be read
+        # _fd     -- file descriptor of _fobj, for positional reads
+        # _lock   -- serialises reads where positional reads are unavailable
+        # _nf     -- next frame to be read by __call__
         # _run    -- name of run
-        # _flt    -- whether to read as float (else uint16)
+        # _dtype  -- dtype to return data as
+        # _bias   -- bias subtracted when converting to float
+        # _gain   -- gain applied when converting to float
+        # _mmap   -- whether to read frames through the memory map
+        # _memmap -- structured memory map of the run, created on demand
+        # _local  -- per-thread uint16 and trailer buffers reused when reading
+        # _executor -- thread pool for asynchronous reads, created on demand
+        # _unix_times -- timestamps of all frames, read on demand
+        # _timestamps -- _unix_times as an astropy Time
+        # _time_index -- sorted _unix_times and matching frame numbers
         if six.PY3:
             """
             This exists because in Python 3, `open()` returns an
@@ -196,21 +464,31 @@ class Ddata(Dhead):
             self._fobj = open(self.run + '.dcimg', 'rb', buffering=0)
         else:
             self._fobj = open(self.run + '.dcimg', 'rb')
+        self._fd = self._fobj.fileno()
+        self._lock = threading.Lock()
         self._nf = nframe
         self._run = self.run
-        self._flt = flt
+        if dtype is None:
+            dtype = np.float64 if flt else np.uint16
+        self._dtype = np.dtype(dtype)
+        if (bias is not None or gain is not None) and self._dtype.kind != 'f':
+            raise DcimgError('Ddata: bias and gain can only be applied to float data')
+        self._bias = bias
+        self._gain = gain
+        self._mmap = mmap
+        self._memmap = None
+        self._local = threading.local()
+        self._executor = None
 
         # first we read in the essential metadata from the dcimg file and add properties
-        try:
-            hdr_bytes = self._read_header_bytes(232)
-            hdr = self._parse_header_bytes_old(hdr_bytes)
-            self.hdr_length = 232
-            self.format = 0
-        except:
-            hdr_bytes = self._read_header_bytes(864)
-            hdr = self._parse_header_bytes(hdr_bytes)
-            self.hdr_length = 864
-            self.format = 1
+        if meta is None:
+            nbytes = max(layout.hdr_length for layout in HEADER_LAYOUTS)
+            layout, hdr = parse_header(self._read_header_bytes(nbytes), self.instrument)
+        else:
+            layout, hdr = meta['layout'], meta['header']
+        self._layout = layout
+        self.hdr_length = layout.hdr_length
+        self.format = layout.format
 
         # set attributes from header
         self.framesize = hdr['bytes_per_img']
@@ -220,38 +498,229 @@ class Ddata(Dhead):
         self.ny = hdr['ysize']
         self.nx = hdr['xsize']
         self.numexp = hdr['nframes']
-        self._footloc = hdr.get('footer_loc', None)
-
-        # timing info is stored in footer in old format, and follows
-        # data in new format. If the old format, store in array.
-        # Otherwise, timestamps are read along with data
-        if self.format == 0:
-            self.timestamps = self._read_timestamps()
-        elif self.format == 1:
-            self.timestamps = None
-        else:
-            raise DcimgError('DCIMG format not recognised')
+
+        # some formats follow each frame with extra info, which may hold the
+        # timestamp. Otherwise timestamps are in a table. Either way, they
+        # are read on first use
+        self._trailer_size = layout.trailer_size
+        self._trailer_time = layout.trailer_time_offset
+        self._time_table = hdr.get('time_table', None)
+        if self._trailer_time is None and self._time_table is None:
+            raise DcimgError('DCIMG header layout {} gives no timestamps'.format(layout.name))
+        self._frameskip = self.framesize + self._trailer_size
+        self._unix_times = None if meta is None else meta['unix_times']
+        self._timestamps = None
+        self._time_index = None
+
+        if sidecar and meta is None:
+            self._write_sidecar(hdr)
 
         # TODO: there's more metadata in the DCIMG files that I don't understand
         # I must manage to decipher this at some point
 
-        # position read pointer ready for image access
-        self._fobj.seek(self.hdr_length + self.framesize*(nframe-1))
+    # Dhead attributes saved in sidecar files
+    _sidecar_attrs = ('exposeTime', 'user', 'instrument', 'nxmax', 'nymax')
+    # version of the sidecar file contents
+    _sidecar_version = 2
+
+    def _sidecar_stamp(self):
+        """Sizes and modification times of the files the sidecar describes"""
+        stamp = {}
+        for ext in ('.dcimg', '.xml'):
+            st = os.stat(self.run + ext)
+            stamp[ext] = [st.st_size, st.st_mtime]
+        return stamp
+
+    def _load_sidecar(self):
+        """
+        Returns the metadata stored in the sidecar file, or None if there is
+        no sidecar or it is out of date.
+        """
+        path = self.run + '.dcimg.idx'
+        if not os.path.exists(path):
+            return None
+        try:
+            with np.load(path, allow_pickle=False) as idx:
+                meta = json.loads(str(idx['meta']))
+                if (meta['version'] != self._sidecar_version or
+                        meta['stamp'] != self._sidecar_stamp()):
+                    return None
+                meta['unix_times'] = idx['unix_times']
+            layouts = [layout for layout in HEADER_LAYOUTS if layout.name == meta['layout']]
+            if not layouts:
+                return None
+            meta['layout'] = layouts[0]
+            return meta
+        except Exception as err:
+            warnings.warn('ignoring unreadable sidecar {}: {}'.format(path, err))
+            return None
+
+    def _write_sidecar(self, hdr):
+        """
+        Saves the metadata of the run to its sidecar file. Failure to write
+        it, e.g. to a read-only archive, only produces a warning.
+        """
+        path = self.run + '.dcimg.idx'
+        meta = dict(version=self._sidecar_version, stamp=self._sidecar_stamp(),
+                    head=dict((attr, getattr(self, attr)) for attr in self._sidecar_attrs),
+                    header=hdr, layout=self._layout.name)
+        tmp = '{}.{}.tmp'.format(path, os.getpid())
+        try:
+            # write to a temporary file and rename it, so that readers never
+            # see a partly written sidecar
+            with open(tmp, 'wb') as fobj:
+                np.savez(fobj, meta=np.array(json.dumps(meta)), unix_times=self.unix_times)
+            if hasattr(os, 'replace'):
+                os.replace(tmp, path)
+            else:
+                if os.path.exists(path):
+                    os.remove(path)
+                os.rename(tmp, path)
+        except (IOError, OSError) as err:
+            warnings.warn('could not write sidecar {}: {}'.format(path, err))
+            if os.path.exists(tmp):
+                os.remove(tmp)
 
     def __iter__(self):
         """
         Generator to allow Ddata to function as an iterator.
         This produces the same type of object as __call__ does.
         """
+        return self.iter()
+
+    def iter(self, reuse_buffer=False, prefetch=0, max_bytes=None):
+        """
+        Iterates over the frames, starting from the next frame to be read.
+
+        Each iterator keeps its own place in the run, so iterating does not
+        move the frame read next by __call__, and several iterators can be
+        used at once, from different threads if need be.
+
+        Args
+        ----
+        reuse_buffer : bool
+            True to read every frame into the same array, rather than
+            allocating a new one for each frame. Each frame is then only
+            valid until the next one is read, so copy it if you need to
+            keep it.
+
+        prefetch : int
+            if > 0, frames are read ahead by a background thread, which keeps
+            up to this many frames waiting in a queue. Disk reads then overlap
+            with whatever is done with each frame. Cannot be combined with
+            reuse_buffer.
+
+        max_bytes : int
+            upper limit to the memory used by the frames waiting in the
+            prefetch queue. At least one frame is always read ahead.
+        """
+        if prefetch > 0:
+            if reuse_buffer:
+                raise DcimgError('Ddata.iter: cannot prefetch into a reused buffer')
+            return self._iter_prefetch(self._nf, prefetch, max_bytes)
+        return self._iter_frames(self._nf, reuse_buffer)
+
+    def _iter_frames(self, first, reuse_buffer):
+        buf = np.empty((self.ny, self.nx), self.dtype) if reuse_buffer else None
+        for nframe in range(first, self.numexp+1):
+            if buf is None:
+                img, trailer = self._read_record(nframe)
+            else:
+                img, trailer = buf, self._read_frame(buf, nframe)
+            yield self._build_ccd(img, nframe, trailer) if useTRM else img
+
+    def _iter_prefetch(self, first, prefetch, max_bytes):
+        depth = prefetch
+        if max_bytes is not None:
+            depth = max(1, min(depth, max_bytes // (self.nx*self.ny*self.dtype.itemsize)))
+        frames = queue.Queue(maxsize=depth)
+        stop = threading.Event()
+        reader = threading.Thread(target=self._prefetch, args=(first, frames, stop))
+        reader.daemon = True
+        reader.start()
         try:
             while 1:
-                yield self.__call__(flt=self._flt)
-        except DendError:
-            pass
+                nframe, item = frames.get()
+                if nframe is None:
+                    if item is not None:
+                        raise item
+                    break
+                yield item
+        finally:
+            stop.set()
+            reader.join()
+
+    def _prefetch(self, first, frames, stop):
+        """
+        Body of the read-ahead thread used by iter. Puts (nframe, frame)
+        on the queue frames, then (None, None) at the end of the run or
+        (None, exception) if reading fails. Gives up if stop is set.
+        """
+        def put(item):
+            while not stop.is_set():
+                try:
+                    frames.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        try:
+            for nframe in range(first, self.numexp+1):
+                if not put((nframe, self._get_frame(nframe))):
+                    return
+        except Exception as err:
+            put((None, err))
+        else:
+            put((None, None))
+
+    def aread(self, nframe=None, flt=None, dtype=None):
+        """
+        Reads a frame without blocking an asyncio event loop.
+
+        Use as ``frame = await ddat.aread(10)`` from a coroutine. This takes
+        the same arguments and gives the same result as __call__, but the
+        read is done in a pool of :attr:`aio_workers` threads, which also
+        limits how many reads are in flight at once.
+        """
+        dtype = self._out_dtype(flt, dtype)
+        nframe = self._frame_number(nframe)
+        if nframe > self.numexp:
+            raise DendError("Number of frames exceeded")
+
+        # move frame counter on now, so successive calls get successive frames
+        self._nf = nframe + 1
+        return self._aread(nframe, dtype)
+
+    def _aread(self, nframe, dtype=None):
+        import asyncio
+        loop = getattr(asyncio, 'get_running_loop', asyncio.get_event_loop)()
+        return loop.run_in_executor(self._aio_executor(), self._get_frame, nframe, dtype)
+
+    def _aio_executor(self):
+        """Thread pool used for asynchronous reads, created on first use"""
+        with self._lock:
+            if self._executor is None:
+                from concurrent.futures import ThreadPoolExecutor
+                self._executor = ThreadPoolExecutor(max_workers=self.aio_workers)
+        return self._executor
+
+    def aiter(self, inflight=4):
+        """
+        Asynchronous iterator over the frames, starting from the next frame
+        to be read, for use in asyncio code::
+
+          async for frame in ddat.aiter():
+              ...
+
+        Up to inflight frames are read ahead in the background. As for
+        :meth:`iter`, this does not move the frame read next by __call__.
+        """
+        return _AsyncFrames(self, self._nf, inflight)
 
     def set(self, nframe=1):
         """
-        Sets the internal file pointer to point at frame nframe.
+        Sets the frame to be read by the next call with no frame number.
 
         Args
         ----
@@ -263,20 +732,366 @@ class Ddata(Dhead):
             file will work, but will cause an exception to be
             raised on the next attempted read.
         """
-        # position read pointer
         if nframe is not None:
-            if nframe < 0:
-                raise DcimgError('Ddata.set: nframe < 0')
-            elif nframe == 0:
-                # go to last valid frame
-                self._fobj.seek(self.hdr_length + self.framesize*(self.numexp-1))
-                self._nf = self.numexp
-            elif self._nf != nframe:
-                frameskip = self.framesize + 32 if self.format else self.framesize
-                self._fobj.seek(self.hdr_length + frameskip*(nframe-1))
-                self._nf = nframe
-
-    def __call__(self, nframe=None, flt=None):
+            self._nf = self._frame_number(nframe)
+
+    def _frame_number(self, nframe):
+        """Frame to read given the nframe argument of a read"""
+        if nframe is None:
+            return self._nf
+        if nframe < 0:
+            raise DcimgError('Ddata: nframe < 0')
+        # 0 means last valid frame
+        return nframe if nframe else self.numexp
+
+    def _frame_offset(self, nframe):
+        """Byte offset of the start of frame nframe (starting at 1)"""
+        return self.hdr_length + self._frameskip*(nframe-1)
+
+    def frame_offset(self, nframe=None):
+        """
+        Returns the byte offset in the .dcimg file of the image data of
+        frame nframe (starts from 1; 0 for the last frame, None for the next
+        frame). The data are :attr:`framesize` bytes long.
+        """
+        nframe = self._frame_number(nframe)
+        if nframe > self.numexp:
+            raise DendError("Number of frames exceeded")
+        return self._frame_offset(nframe)
+
+    def fileno(self):
+        """Returns the file descriptor of the open .dcimg file"""
+        return self._fd
+
+    def frame_dtype(self):
+        """
+        Returns the structured numpy dtype of one frame record on disk.
+
+        The image data are in the 'data' field, as little-endian unsigned
+        2-byte ints of shape (ny, nx). Formats with extra info after each
+        frame, such as the new format, also have a 'trailer' field holding it.
+        """
+        fields = [('data', '<u2', (self.ny, self.nx))]
+        if self._trailer_size:
+            fields.append(('trailer', 'u1', (self._trailer_size,)))
+        return np.dtype(fields)
+
+    def memmap(self):
+        """
+        Returns a read-only :class:`numpy.memmap` of the whole run.
+
+        The memory map is a 1D array of numexp records with the dtype given
+        by :meth:`frame_dtype`, so ``ddat.memmap()['data']`` is a
+        (numexp, ny, nx) view of all the image data in the run. Nothing is
+        read from disk until it is accessed. The map is created on first
+        use and cached.
+        """
+        if self._memmap is None:
+            self._memmap = np.memmap(self.run + '.dcimg', dtype=self.frame_dtype(),
+                                     mode='r', offset=self.hdr_length,
+                                     shape=(self.numexp,))
+        return self._memmap
+
+    def _readinto_at(self, offset, buf):
+        """
+        Fill the writable buffer buf with the bytes starting at offset.
+
+        This neither uses nor moves the file position, so it is safe to call
+        from several threads at once.
+        """
+        nbytes = buf.nbytes if hasattr(buf, 'nbytes') else len(buf)
+        nread = 0
+        if _HAVE_PREADV:
+            view = memoryview(buf).cast('B')
+            while nread < nbytes:
+                n = os.preadv(self._fd, [view[nread:]], offset+nread)
+                if n == 0:
+                    break
+                nread += n
+        elif _HAVE_PREAD:
+            view = memoryview(buf).cast('B')
+            while nread < nbytes:
+                data = os.pread(self._fd, nbytes-nread, offset+nread)
+                if not data:
+                    break
+                view[nread:nread+len(data)] = data
+                nread += len(data)
+        else:
+            with self._lock:
+                self._fobj.seek(offset)
+                nread = self._fobj.readinto(buf)
+        if nread != nbytes:
+            raise DcimgError('Ddata: failed to read {} bytes at offset {}'.format(nbytes, offset))
+
+    def _read_at(self, offset, nbytes):
+        """Returns the nbytes bytes starting at offset, as for _readinto_at"""
+        buf = bytearray(nbytes)
+        self._readinto_at(offset, buf)
+        return bytes(buf)
+
+    def _scratch(self):
+        """
+        Returns a uint16 frame buffer and a trailer buffer belonging to the
+        calling thread, for reuse between reads.
+        """
+        local = self._local
+        if not hasattr(local, 'rawbuf'):
+            local.rawbuf = np.empty((self.ny, self.nx), '<u2')
+            local.trailer = bytearray(self._trailer_size)
+        return local.rawbuf, local.trailer
+
+    @property
+    def shape(self):
+        """Shape of the run when indexed as an array, (numexp, ny, nx)"""
+        return (self.numexp, self.ny, self.nx)
+
+    @property
+    def ndim(self):
+        return 3
+
+    @property
+    def dtype(self):
+        """dtype of the arrays returned by indexing the run"""
+        return self._dtype
+
+    def _out_dtype(self, flt=None, dtype=None):
+        """dtype to read data as, given the flt and dtype arguments of a read"""
+        if dtype is not None:
+            return np.dtype(dtype)
+        if flt is None:
+            return self._dtype
+        if not flt:
+            return np.dtype(np.uint16)
+        return self._dtype if self._dtype.kind == 'f' else np.dtype(np.float64)
+
+    def _scale(self, img):
+        """Applies bias and gain in place to data converted to floats"""
+        if img.dtype.kind == 'f':
+            if self._bias is not None:
+                img -= self._bias
+            if self._gain is not None:
+                img *= self._gain
+        return img
+
+    def __len__(self):
+        return self.numexp
+
+    def __array__(self, dtype=None):
+        arr = self[:]
+        return arr if dtype is None else arr.astype(dtype)
+
+    def __getitem__(self, key):
+        """
+        Index the run as a numpy array of shape (numexp, ny, nx).
+
+        For example ``ddat[100:200, 512:1024, :]``. Note that frames are
+        numbered from 0 here, as for any numpy array, and not from 1 as
+        for :meth:`__call__`. For each frame requested, only the bytes from
+        the first to the last pixel requested are read from disk.
+
+        Unlike numpy, lists or arrays of indices select along each axis
+        independently, as if passed through :func:`numpy.ix_`, and integer
+        indices remove their axis in place. So ``ddat[[0, 1], 2, [3, 4]]``
+        has shape (2, 2) and ``ddat[-1, ::3, [1, 5, 2]]`` has shape
+        (ny//3, 3) (rounded up), whether or not the Ddata uses mmap.
+        """
+        if not isinstance(key, tuple):
+            key = (key,)
+        if any(k is Ellipsis for k in key):
+            i = [k is Ellipsis for k in key].index(True)
+            key = key[:i] + (slice(None),)*(4-len(key)) + key[i+1:]
+        if len(key) > 3:
+            raise IndexError('too many indices for Ddata')
+        key = key + (slice(None),)*(3-len(key))
+
+        # with only slices and integers, numpy indexing is the same, and the
+        # memory map gives a view
+        basic = all(isinstance(k, slice) or np.ndim(k) == 0 for k in key)
+        if self._mmap and basic:
+            img = self.memmap()['data'][key]
+            return self._scale(img.astype(self.dtype)) if self.dtype != img.dtype else img
+
+        # positions requested along each axis. Integer indices remove an axis.
+        frames, rows, cols = [np.arange(n)[k] for n, k in zip(self.shape, key)]
+        squeeze = tuple(0 if np.ndim(idx) == 0 else slice(None)
+                        for idx in (frames, rows, cols))
+        frames, rows, cols = [np.atleast_1d(idx) for idx in (frames, rows, cols)]
+
+        if self._mmap:
+            img = self.memmap()['data'][np.ix_(frames, rows, cols)][squeeze]
+            return self._scale(img.astype(self.dtype)) if self.dtype != img.dtype else img
+
+        out = np.empty((len(frames), len(rows), len(cols)), self.dtype)
+        if out.size:
+            # read the span from pixel (r0, c0) to pixel (r1, c1) inclusive
+            # into a block of whole rows, so it can be indexed as 2D
+            r0, r1 = rows.min(), rows.max()
+            c0, c1 = cols.min(), cols.max()
+            npix = (r1-r0)*self.nx + c1 - c0 + 1
+            block = np.empty((r1-r0+1)*self.nx, '<u2')
+            span = block[c0:c0+npix]
+            block = block.reshape(r1-r0+1, self.nx)
+            sel = np.ix_(rows-r0, cols)
+            for i, n in enumerate(frames):
+                self._readinto_at(self._frame_offset(n+1) + 2*(r0*self.nx + c0), span)
+                out[i] = block[sel]
+        return self._scale(out)[squeeze]
+
+    def read_frames(self, frames, out=None, dtype=None):
+        """
+        Reads a set of frames into a single array of shape (N, ny, nx).
+
+        Runs of consecutive frame numbers are read from disk in as few
+        reads as possible, straight into the output array where the data
+        need no conversion, so reading a block of frames proceeds at close
+        to disk speed. The sequential read position is left untouched.
+
+        Parameters
+        ----------
+        frames : iterable of int
+            frame numbers to read, starting at 1 for the first frame.
+        out : numpy.ndarray, optional
+            array of shape (N, ny, nx) to fill in place, where N is the
+            number of frames. A new array is created if this is not given.
+        dtype : numpy dtype, optional
+            dtype of the array created if out is not given. Defaults to
+            :attr:`dtype`. Any bias and gain are applied if this, or the
+            dtype of out, is a float type.
+
+        Returns
+        -------
+        out : numpy.ndarray
+            the frames read.
+        """
+        frames = np.asarray(list(frames), dtype=int)
+        if len(frames) and (frames.min() < 1 or frames.max() > self.numexp):
+            raise DcimgError('Ddata.read_frames: frame numbers must lie between 1 and {}'.format(
+                             self.numexp))
+        shape = (len(frames), self.ny, self.nx)
+        if out is None:
+            out = np.empty(shape, self._out_dtype(dtype=dtype))
+        elif out.shape != shape:
+            raise DcimgError('Ddata.read_frames: out has shape {}, expected {}'.format(
+                             out.shape, shape))
+
+        # frames can only be read straight into out if they are stored
+        # back to back on disk, and out has the same layout
+        direct = (self._frameskip == self.framesize and out.dtype == np.dtype('<u2') and
+                  out.flags.c_contiguous)
+        # limit the size of each read so any intermediate buffer stays modest
+        maxrun = max(1, self._max_read_bytes // self._frameskip)
+        buf = None
+
+        # split into runs of consecutive frame numbers
+        breaks = np.flatnonzero(np.diff(frames) != 1) + 1
+        starts = np.concatenate(([0], breaks))
+        stops = np.concatenate((breaks, [len(frames)]))
+        for start, stop in zip(starts, stops):
+            for i in range(start, stop, maxrun):
+                j = min(i+maxrun, stop)
+                if self._mmap:
+                    out[i:j] = self.memmap()['data'][frames[i]-1:frames[j-1]]
+                elif direct:
+                    self._readinto_at(self._frame_offset(frames[i]), out[i:j])
+                else:
+                    if buf is None:
+                        buf = np.empty(min(maxrun, len(frames)), self.frame_dtype())
+                    self._readinto_at(self._frame_offset(frames[i]), buf[:j-i])
+                    out[i:j] = buf['data'][:j-i]
+        return self._scale(out)
+
+    def map(self, func, frames=None, workers=None, chunk=None, reducer=None, initial=None):
+        """
+        Applies a function to many frames in parallel, using a pool of processes.
+
+        Each worker process opens the run for itself and reads the frames it
+        is given in batches, so frame data are never passed between
+        processes; only the results of func are. The run is split into
+        chunks of consecutive frames which are handed out to the workers.
+
+        Args
+        ----
+        func : callable
+            called with the (ny, nx) array of each frame, as returned when
+            reading with the dtype, bias and gain of this Ddata. It must
+            be picklable, i.e. defined at the top level of a module. The
+            array is reused for later frames, so func should not return or
+            keep a reference to it.
+
+        frames : iterable of int
+            frame numbers to process, starting at 1. Defaults to all frames.
+
+        workers : int
+            number of worker processes. Defaults to the number of CPUs.
+            With 1, the frames are processed in this process.
+
+        chunk : int
+            number of frames handed to a worker at a time. Defaults to
+            spreading the frames over about four chunks per worker.
+
+        reducer : callable
+            if given, the results are combined in frame order with
+            ``functools.reduce(reducer, results, initial)`` as they
+            arrive, and the combined value is returned.
+
+        initial : object
+            starting value for the reducer.
+
+        Returns
+        -------
+        results : list or object
+            the results of func for each frame, in order, or the combined
+            value if a reducer was given.
+        """
+        frames = list(range(1, self.numexp+1)) if frames is None else list(frames)
+        if workers is None:
+            workers = multiprocessing.cpu_count()
+        if chunk is None:
+            chunk = max(1, -(-len(frames) // (4*workers)))
+        chunks = [frames[i:i+chunk] for i in range(0, len(frames), chunk)]
+
+        pool = None
+        if workers == 1:
+            results = (self._apply(func, frms) for frms in chunks)
+        else:
+            kwargs = dict(dtype=self._dtype, bias=self._bias, gain=self._gain, mmap=self._mmap)
+            pool = multiprocessing.Pool(workers, _map_init, (self.run, kwargs))
+            results = pool.imap(_map_chunk, [(func, frms) for frms in chunks])
+
+        try:
+            results = (result for chunk_results in results for result in chunk_results)
+            if reducer is None:
+                results = list(results)
+            elif initial is None:
+                results = reduce(reducer, results)
+            else:
+                results = reduce(reducer, results, initial)
+        except:
+            if pool is not None:
+                pool.terminate()
+                pool = None
+            raise
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+        return results
+
+    def _apply(self, func, frames):
+        """
+        Returns the list of results of func applied to each of frames,
+        reading them in batches into a reused buffer.
+        """
+        batch = max(1, self._max_read_bytes // (self.nx*self.ny*self.dtype.itemsize))
+        buf = np.empty((min(batch, len(frames)), self.ny, self.nx), self.dtype)
+        results = []
+        for i in range(0, len(frames), batch):
+            frms = frames[i:i+batch]
+            imgs = self.read_frames(frms, out=buf[:len(frms)])
+            results.extend(func(img) for img in imgs)
+        return results
+
+    def __call__(self, nframe=None, flt=None, dtype=None):
         """
         Reads the data of frame nframe (starts from 1) and returns a
         CCD object, depending upon the type of data. If nframe is None,
@@ -295,32 +1110,153 @@ class Ddata(Dhead):
             Set True to return data as floats. The data are stored on
             disk as unsigned 2-byte ints. If you are not doing much to
             the data, and wish to keep them in this form for speed and
-            efficiency, then set flt=False.
+            efficiency, then set flt=False. True gives the float dtype
+            the Ddata was created with, or np.float64 if it has none.
+
+        dtype : numpy dtype
+            dtype to return the data as. Overrides flt if set.
         """
-        if flt is None:
-            flt = self._flt
-        if self._nf > self.numexp:
+        dtype = self._out_dtype(flt, dtype)
+        nframe = self._frame_number(nframe)
+        if nframe > self.numexp:
             raise DendError("Number of frames exceeded")
 
-        # position read pointer
-        self.set(nframe)
-
-        im_bytes = self._fobj.read(self.framesize)
-        img = np.fromstring(im_bytes, np.uint16).reshape(self.ny, self.nx)
-        if flt:
-            img = img.astype(np.float)
-
-        # if old format, we're done. Otherwise read in extra bytes
-        if self.format == 1:
-            extra_bytes = self._fobj.read(32)
+        # move frame counter on
+        self._nf = nframe + 1
+        return self._get_frame(nframe, dtype)
 
-        # move frame counter on by one
-        self._nf += 1
+    def _get_frame(self, nframe, dtype=None):
+        """
+        Reads frame nframe and returns it as __call__ does, without using or
+        moving the frame read next by __call__.
+        """
+        img, trailer = self._read_record(nframe, dtype)
 
         # if we can't install Tom's module, just return numpy array
         if not useTRM:
             return img
+        return self._build_ccd(img, nframe, trailer)
+
+    def read_into(self, buf, nframe=None):
+        """
+        Reads the data of frame nframe (starts from 1) into an existing array.
+
+        This avoids allocating new arrays for every frame. If buf holds
+        little-endian unsigned 2-byte ints, the data are read straight into
+        it. Otherwise they are read into an internal buffer that is kept
+        between calls, and converted into buf in place, applying any bias
+        and gain if buf holds floats.
+
+        Args
+        ----
+        buf : numpy.ndarray
+            array of shape (ny, nx) to hold the data.
+
+        nframe : int
+            frame number to get, starting at 1. 0 for the last
+            (complete) frame. None just reads the next frame.
+
+        Returns
+        -------
+        buf : numpy.ndarray
+            the array passed in, now holding the frame.
+        """
+        if buf.shape != (self.ny, self.nx):
+            raise DcimgError('Ddata.read_into: buffer has shape {}, expected {}'.format(
+                             buf.shape, (self.ny, self.nx)))
+
+        nframe = self._frame_number(nframe)
+        if nframe > self.numexp:
+            raise DendError("Number of frames exceeded")
+
+        self._read_frame(buf, nframe)
+
+        # move frame counter on
+        self._nf = nframe + 1
+        return buf
+
+    def read_raw(self, nframe=None, out=None):
+        """
+        Reads the image data of frame nframe (starts from 1) as the bytes
+        stored on disk, i.e. little-endian unsigned 2-byte ints, row by row,
+        without decoding them. No bias or gain is applied. Unlike
+        :meth:`__call__`, this does not move the frame read next.
+
+        Args
+        ----
+        nframe : int
+            frame number to get, starting at 1. 0 for the last
+            (complete) frame. None reads the next frame.
+
+        out : writable buffer
+            buffer of :attr:`framesize` bytes to read into. A new bytearray
+            is made if None.
+
+        Returns
+        -------
+        out : bytearray or writable buffer
+            the bytes of the frame.
+        """
+        nframe = self._frame_number(nframe)
+        if nframe > self.numexp:
+            raise DendError("Number of frames exceeded")
+        if out is None:
+            out = bytearray(self.framesize)
+        self._readinto_at(self._frame_offset(nframe), out)
+        return out
+
+    def _read_frame(self, buf, nframe):
+        """
+        Reads frame nframe (starting at 1) into the (ny, nx) array buf,
+        converting and scaling the data as needed. This does not use or
+        move the frame read next by __call__.
 
+        Returns the trailer bytes that follow the frame in formats that have
+        them, such as the new format, or None. The trailer is only valid until the
+        next read by the same thread.
+        """
+        trailer = None
+        if self._mmap:
+            mm = self.memmap()
+            np.copyto(buf, mm['data'][nframe-1], casting='unsafe')
+            if self._trailer_size:
+                trailer = mm['trailer'][nframe-1].tobytes()
+        else:
+            rawbuf, trailer_buf = self._scratch()
+            raw = buf if buf.dtype == np.dtype('<u2') and buf.flags.c_contiguous else rawbuf
+            offset = self._frame_offset(nframe)
+            self._readinto_at(offset, raw)
+            if raw is not buf:
+                np.copyto(buf, raw, casting='unsafe')
+
+            # read in any extra bytes after the frame
+            if self._trailer_size:
+                self._readinto_at(offset + self.framesize, trailer_buf)
+                trailer = trailer_buf
+        self._scale(buf)
+        return trailer
+
+    def _read_record(self, nframe, dtype=None):
+        """
+        Reads frame nframe (starting at 1) into a new array of the given
+        dtype (:attr:`dtype` by default). In mmap mode, uint16 data are
+        returned as a view onto the file instead.
+
+        Returns the data and the trailer as for _read_frame.
+        """
+        dtype = self.dtype if dtype is None else np.dtype(dtype)
+        if self._mmap and dtype == np.dtype('<u2'):
+            mm = self.memmap()
+            trailer = mm['trailer'][nframe-1].tobytes() if self._trailer_size else None
+            return mm['data'][nframe-1], trailer
+        img = np.empty((self.ny, self.nx), dtype)
+        return img, self._read_frame(img, nframe)
+
+    def _build_ccd(self, img, nframe, trailer):
+        """
+        Builds a :class:`trm.ultracam.CCD` from the data of frame nframe,
+        which was followed on disk by the bytes in trailer.
+        """
         # now to build a :class:trm.ultracam.CCD object from the data
         # first we build a header
         head = Uhead()
@@ -341,7 +1277,7 @@ class Ddata(Dhead):
         head.add_entry('Run.expose', self.exposeTime, ITYPE_FLOAT, 'exposure time')
 
         head.add_entry('Frame', 'Frame specific information')
-        head.add_entry('Frame.frame', self._nf-1,
+        head.add_entry('Frame.frame', nframe,
                        ITYPE_INT, 'frame number within run')
 
         # interpret data
@@ -352,10 +1288,11 @@ class Ddata(Dhead):
 
             # Build the UTime
             # expTime is same as delay
-            if self.format == 0:
-                ts = self.timestamps[self._nf-2]
+            if self._trailer_time is None:
+                ts = self.timestamps[nframe-1]
             else:
-                ts_val = self._decode_float(extra_bytes[4:8], extra_bytes[8:12])
+                pos = self._trailer_time
+                ts_val = self._decode_float(trailer[pos:pos+4], trailer[pos+4:pos+8])
                 ts = Time(ts_val, format='unix')
             time = UTime(ts.mjd, self.exposeTime, True, '')
 
@@ -372,157 +1309,105 @@ class Ddata(Dhead):
         return self._nf
 
     def time(self, nframe=None):
-        if self.format == 0:
-            frame_no = nframe if nframe else self._nf
-            return self.timestamps[frame_no - 1]
-        elif self.format == 1:
-            # store current file position so we can hop back at end
-            curr_loc = self._fobj.tell()
-            frame_no = nframe if nframe else self._nf
-            frameskip = self.framesize + 32
-            try:
-                self._fobj.seek(self.hdr_length + (frame_no-1)*frameskip + self.framesize)
-                extra_bytes = self._fobj.read(32)
-                ts_val = self._decode_float(extra_bytes[4:8], extra_bytes[8:12])
-                ts = Time(ts_val, format='unix')
-            except Exception as ex:
-                warnings.warn(str(ex))
-            finally:
-                # return to original loc, even in case of error
-                self._fobj.seek(curr_loc)
-            return ts
+        """
+        Returns the timestamp of frame nframe (starting at 1) as an
+        :class:`astropy.time.Time`. Defaults to the next frame to be read.
+        """
+        frame_no = nframe if nframe else self._nf
+        return self.timestamps[frame_no - 1]
 
-    def _read_header_bytes(self, nbytes):
-        self._fobj.seek(0)
-        # initial metadata block
-        return self._fobj.read(nbytes)
+    @property
+    def unix_times(self):
+        """
+        Timestamps of all the frames as a float64 array of unix times.
 
-    def _parse_header_bytes(self, hdr_bytes):
+        These are read from the file in one pass the first time they are
+        needed, and cached.
         """
-        Decode header info from newer format DCIMG files.
+        if self._unix_times is None:
+            self._unix_times = self._read_timestamps()
+        return self._unix_times
 
-        Since the DCIMG format is not documented, this metadata is reverse engineered and may
-        be in error
+    @property
+    def timestamps(self):
         """
-        header = {}
-        # nframes
-        curr_index = 36
-        nfrms = from_bytes(hdr_bytes[curr_index:curr_index+4], byteorder='little')
-        header['nframes'] = nfrms
-
-        # filesize
-        curr_index = 48
-        header['filesize'] = from_bytes(hdr_bytes[curr_index:curr_index+4], byteorder='little')
-
-        # bytes per pixel
-        curr_index = 236
-        header['bitdepth'] = int(from_bytes(hdr_bytes[curr_index:curr_index+4],
-                                            byteorder='little') / 2)
-
-        # number of columns (x-size)
-        curr_index = 184
-        header['xsize_req'] = from_bytes(hdr_bytes[curr_index:curr_index+4], byteorder='little')
-
-        # bytes per row
-        curr_index = 192
-        header['bytes_per_row'] = from_bytes(hdr_bytes[curr_index:curr_index+4], byteorder='little')
-        # if we requested an image of nx by ny pixels, then DCIMG files
-        # for the ORCA flash 4.0 still save the full array in x.
-        header['xsize'] = int(header['bytes_per_row']/2)
-
-        # number of rows
-        curr_index = 188
-        header['ysize'] = from_bytes(hdr_bytes[curr_index:curr_index+4], byteorder='little')
-
-        # bytes per image
-        curr_index = 196
-        header['bytes_per_img'] = from_bytes(hdr_bytes[curr_index:curr_index+4], byteorder='little')
-
-        if header['bytes_per_img'] != header['bytes_per_row']*header['ysize']:
-            err_str = ("bytes per img ({bytes_per_img}) /= " +
-                       "nrows ({ysize}) * bytes_per_row ({bytes_per_row})".format(**header))
-            raise DcimgError(err_str)
-
-        # TODO: what about ystart?
-
-        # binning
-        # this only works because MOSCAM always reads out 2048 pixels per row
-        # at least when connected via cameralink. This would fail on USB3 connection
-        # and probably for other cameras.
-        # TODO: find another way to work out binning
-        curr_index = 791
-
-        header['binning'] = int(from_bytes(hdr_bytes[curr_index:curr_index+4], byteorder='little')/16/16)
-        return header
+        Timestamps of all the frames as a single :class:`astropy.time.Time`.
+        """
+        if self._timestamps is None:
+            self._timestamps = Time(self.unix_times, format='unix')
+        return self._timestamps
 
-    def _parse_header_bytes_old(self, hdr_bytes):
-        """Decode header information from OLD FORMAT DCIMG files
+    def _read_unix_time(self, nframe):
+        """
+        Returns the unix time of frame nframe (starting at 1), reading just
+        that timestamp from the file if the table of all of them has not
+        been read yet.
+        """
+        if self._unix_times is not None:
+            return float(self._unix_times[nframe-1])
+        if self._trailer_time is not None:
+            offset = self._frame_offset(nframe) + self.framesize + self._trailer_time
+        else:
+            offset = self._time_table + 8*(nframe-1)
+        pair = np.frombuffer(self._read_at(offset, 8), '<u4').reshape(1, 2)
+        return float(self._decode_floats(pair)[0])
 
-        Since the DCIMG format is not documented, this metadata is reverse engineered and may
-        be in error
+    def frames_between(self, t0, t1):
         """
-        header = {}
-        bytes_to_skip = 4*from_bytes(hdr_bytes[8:12], byteorder='little')
-
-        curr_index = 8 + bytes_to_skip
-
-        # nframes
-        nfrms = from_bytes(hdr_bytes[curr_index:curr_index+4], byteorder='little')
-        header['nframes'] = nfrms
-
-        # filesize
-        curr_index = 48
-        header['filesize'] = from_bytes(hdr_bytes[curr_index:curr_index+4], byteorder='little')
-
-        # bytes per pixel
-        curr_index = 156
-        header['bitdepth'] = 8*from_bytes(hdr_bytes[curr_index:curr_index+4], byteorder='little')
-
-        # footer location
-        curr_index = 120
-        header['footer_loc'] = from_bytes(hdr_bytes[curr_index:curr_index+4], byteorder='little')
-
-        # number of columns (x-size)
-        curr_index = 164
-        header['xsize_req'] = from_bytes(hdr_bytes[curr_index:curr_index+4], byteorder='little')
-
-        # bytes per row
-        curr_index = 168
-        header['bytes_per_row'] = from_bytes(hdr_bytes[curr_index:curr_index+4], byteorder='little')
-        # if we requested an image of nx by ny pixels, then DCIMG files
-        # for the ORCA flash 4.0 still save the full array in x.
-        header['xsize'] = int(header['bytes_per_row']/2)
-
-        # binning
-        # this only works because MOSCAM always reads out 2048 pixels per row
-        # at least when connected via cameralink. This would fail on USB3 connection
-        # and probably for other cameras.
-        # TODO: find another way to work out binning
-        header['binning'] = int(4096/header['bytes_per_row'])
-
-        # funny entry pair which references footer location
-        curr_index = 192
-        odd = from_bytes(hdr_bytes[curr_index:curr_index+4], byteorder='little')
-        curr_index = 40
-        offset = from_bytes(hdr_bytes[curr_index:curr_index+4], byteorder='little')
-        header['footer_loc'] = odd+offset
-
-        # number of rows
-        curr_index = 172
-        header['ysize'] = from_bytes(hdr_bytes[curr_index:curr_index+4], byteorder='little')
-
-        # TODO: what about ystart?
-
-        # bytes per image
-        curr_index = 176
-        header['bytes_per_img'] = from_bytes(hdr_bytes[curr_index:curr_index+4], byteorder='little')
-
-        if header['bytes_per_img'] != header['bytes_per_row']*header['ysize']:
-            err_str = ("bytes per img ({bytes_per_img}) /= " +
-                       "nrows ({ysize}) * bytes_per_row ({bytes_per_row})".format(**header))
-            raise DcimgError(err_str)
+        Returns the frames with timestamps between t0 and t1 inclusive.
 
-        return header
+        The frames are found by binary search of a sorted index of the
+        timestamps, built on first use.
+
+        Args
+        ----
+        t0, t1 : astropy.time.Time, str or float
+            start and end of the time range, as Time objects, strings
+            that Time understands, or unix times.
+
+        Returns
+        -------
+        frames : numpy.ndarray
+            frame numbers, starting at 1, in increasing order. These can be
+            passed straight to :meth:`read_frames` or :meth:`map`.
+        """
+        times, frames = self._sorted_times()
+        lo = np.searchsorted(times, self._unix_time(t0), 'left')
+        hi = np.searchsorted(times, self._unix_time(t1), 'right')
+        return np.sort(frames[lo:hi])
+
+    def frame_at(self, t):
+        """
+        Returns the number (starting at 1) of the last frame timestamped at
+        or before time t, which can be given as for :meth:`frames_between`.
+        """
+        times, frames = self._sorted_times()
+        i = np.searchsorted(times, self._unix_time(t), 'right') - 1
+        if i < 0:
+            raise DcimgError('Ddata.frame_at: time is before the first frame')
+        return int(frames[i])
+
+    def _sorted_times(self):
+        """Returns the sorted unix times of the frames and their frame numbers"""
+        if self._time_index is None:
+            times = self.unix_times
+            if np.all(np.diff(times) >= 0):
+                self._time_index = (times, np.arange(1, self.numexp+1))
+            else:
+                order = np.argsort(times, kind='mergesort')
+                self._time_index = (times[order], order+1)
+        return self._time_index
+
+    @staticmethod
+    def _unix_time(t):
+        if isinstance(t, six.string_types):
+            t = Time(t)
+        return t.unix if isinstance(t, Time) else float(t)
+
+    def _read_header_bytes(self, nbytes):
+        # initial metadata block, or as much of it as the file holds
+        nbytes = min(nbytes, os.fstat(self._fd).st_size)
+        return self._read_at(0, nbytes)
 
     def _decode_float(self, whole_bytes, frac_bytes):
         """Decode floats from DCIMG format
@@ -537,8 +1422,19 @@ class Ddata(Dhead):
         else:
             return whole + frac * 10**-(floor(log10(frac))+1)
 
+    def _decode_floats(self, pairs):
+        """Decode an array of floats from DCIMG format
+
+        Vectorised version of _decode_float. pairs is an (N, 2) array of the
+        whole and fractional parts of N floats."""
+        whole = pairs[:, 0].astype(np.float64)
+        frac = pairs[:, 1].astype(np.float64)
+        nonzero = frac > 0
+        digits = np.floor(np.log10(np.where(nonzero, frac, 1))) + 1
+        return whole + np.where(nonzero, frac * 10**-digits, 0)
+
     def _read_timestamps(self):
-        """reads in the timestamps saved in the DCIMG file
+        """reads in the timestamps saved in the DCIMG file, as unix times
 
         The DCIMG recorder saves a timestamp for each frame. Although this is not
         documented, these are probably from the system clock. I am yet to work out if
@@ -550,24 +1446,63 @@ class Ddata(Dhead):
         yet which part. The entire chip takes 1/100th of a second to read out, so this
         is only relevant at very high timing accuracies
         """
-        # go to start of timing info
-        # footer consists of 272 bytes of information I don't yet understand
-        # then numexp*4 bytes which are a record of the frame numbers
-        # then 8 bytes of timing info per frame
-        currloc = self._fobj.tell()
-        self._fobj.seek(self._footloc + 272 + self.numexp*4)
-
-        # read in timestamps
-        timestamps = []
-        for i in range(self.numexp):
-            a = self._fobj.read(4)
-            b = self._fobj.read(4)
-            val = self._decode_float(a, b)
-            timestamps.append(val)
-
-        # it's good if this can be called without ruining reading of image data,
-        # so go back to original location
-        self._fobj.seek(currloc)
-
-        # convert to astropy.Time
-        return Time(timestamps, format='unix')
+        if self._trailer_time is not None:
+            # the timestamp is in the extra info after each frame. Map the
+            # file with a record per frame holding just it, so only the
+            # pages that contain them are read.
+            pos = self.framesize + self._trailer_time
+            dtype = np.dtype({'names': ['whole', 'frac'], 'formats': ['<u4', '<u4'],
+                              'offsets': [pos, pos+4],
+                              'itemsize': self._frameskip})
+            table = np.memmap(self.run + '.dcimg', dtype=dtype, mode='r',
+                              offset=self.hdr_length, shape=(self.numexp,))
+            pairs = np.column_stack((table['whole'], table['frac']))
+            del table
+            return self._decode_floats(pairs)
+
+        # otherwise the timestamps are in a table of 8 bytes per frame,
+        # read in one go
+        table = self._read_at(self._time_table, 8*self.numexp)
+        return self._decode_floats(np.frombuffer(table, '<u4').reshape(-1, 2))
+
+
+# the Ddata opened by each worker process of Ddata.map
+_map_ddata = None
+
+
+def _map_init(run, kwargs):
+    global _map_ddata
+    _map_ddata = Ddata(run, **kwargs)
+
+
+def _map_chunk(args):
+    func, frames = args
+    return _map_ddata._apply(func, frames)
+
+
+class _AsyncFrames(object):
+    """
+    Asynchronous iterator over the frames of a Ddata, returned by Ddata.aiter.
+    Keeps up to inflight reads going ahead of the frame being waited for.
+    """
+    def __init__(self, ddat, first, inflight):
+        self._ddat = ddat
+        self._next = first
+        self._inflight = max(1, inflight)
+        self._pending = collections.deque()
+
+    def __aiter__(self):
+        return self
+
+    def __anext__(self):
+        while len(self._pending) < self._inflight and self._next <= self._ddat.numexp:
+            self._pending.append(self._ddat._aread(self._next))
+            self._next += 1
+        if self._pending:
+            return self._pending.popleft()
+
+        import asyncio
+        loop = getattr(asyncio, 'get_running_loop', asyncio.get_event_loop)()
+        end = loop.create_future()
+        end.set_exception(StopAsyncIteration())
+        return end
@@ -12,5 +12,6 @@ from ._astropy_init import *
 
 # For egg_info test builds to pass, put package imports here.
 if not _ASTROPY_SETUP_:
-    from Raw import Dhead, DcimgError, Ddata
+    from Raw import Dhead, DcimgError, Ddata, HeaderLayout, register_header_layout
+    from Catalogue import build_catalogue, read_catalogue, scan_run
     
\ No newline at end of file
@@ -1,8 +1,9 @@
 from __future__ import absolute_import
 from __future__ import print_function
 
-from collections import MutableMapping
+from collections import MutableMapping, Mapping
 from itertools import chain
+import six
 import itertools
 try:
     imap = itertools.imap
@@ -34,6 +35,11 @@ class ContextDict(MutableMapping):
     k in d                  Check all nested values
     len(d)                  Number of nested values
     d.items()               All nested items
+    d.find_key_refs('x', True)  All contexts in the tree under d holding 'x'
+
+    Every context keeps an index from key to the contexts in its subtree
+    that hold the key, kept up to date by sets, deletes, new_child and
+    new_child_adopt, so find_key_refs does not have to walk the tree.
 
     Mutations (such as sets and deletes) are restricted to the current context
     when "enable_nonlocal" is set to False (the default).  So c[k]=v will always
@@ -69,6 +75,8 @@ class ContextDict(MutableMapping):
         self.enable_nonlocal = enable_nonlocal
         self.map = {}
         self.maps = [self.map]
+        self._key_index = {}
+        self._path = None
 #        if parent is not None:
 #            self.maps += parent.maps
 
@@ -87,31 +95,59 @@ class ContextDict(MutableMapping):
         enable_nonlocal = self.enable_nonlocal if enable_nonlocal is None else enable_nonlocal
         
         #local_new_child = self.__class__(enable_nonlocal=enable_nonlocal, parent=self)
-        self.__setitem__(key,input_adopted_child)
         input_adopted_child.parent      = self
         input_adopted_child.parentkey   = key 
+        input_adopted_child._clear_path()
+        self.__setitem__(key,input_adopted_child)
         
         return input_adopted_child
 
+    def _index(self, key, value):
+        # record that self holds key, in self and all its ancestors, along
+        # with the subtree under value if it is a child context of self
+        entries = [(key, [self])]
+        if isinstance(value, ContextDict) and value.parent is self:
+            entries.extend(value._key_index.items())
+        node = self
+        while node is not None:
+            for k, owners in entries:
+                node._key_index.setdefault(k, []).extend(owners)
+            node = node.parent
+
+    def _unindex(self, key, value):
+        # the reverse of _index
+        entries = [(key, [self])]
+        if isinstance(value, ContextDict) and value.parent is self:
+            entries.extend(value._key_index.items())
+        node = self
+        while node is not None:
+            for k, owners in entries:
+                node_owners = node._key_index[k]
+                for owner in owners:
+                    node_owners.remove(owner)
+                if not node_owners:
+                    del node._key_index[k]
+            node = node.parent
+
+    def _clear_path(self):
+        # forget cached paths to the root. If a context has none cached,
+        # nor have any of its children
+        if self._path is None:
+            return
+        self._path = None
+        for value in self.map.values():
+            if isinstance(value, ContextDict) and value.parent is self:
+                value._clear_path()
+
     def find_key_refs(self, key, sublevels = False):
         # returns list of references to all dictionarys with the key present (** doesn't return the actual value - but easily found)
- 
-        keylist = list() 
-        #print str(self.map)
-        for m in self.map: 
-            if key in m:
-                keylist.append(self)            
-                
-            #print str(m)
-            if sublevels :
-                try :
-                    keylist.extend(self.map[m].find_key_refs(key, sublevels))
-                except AttributeError:
-                    pass                    
-            
+        if sublevels :
+            return list(self._key_index.get(key, ()))
+        return [self] if key in self.map else []
 
-                  
-        return keylist
+    def find_key_paths(self, key):
+        # returns the paths from the root to every occurence of key under this context
+        return [ref.return_path_to_root("['{}']".format(key)) for ref in self.find_key_refs(key, True)]
         
    
     def find_key_value(self, key, sublevels = False):
@@ -134,9 +170,19 @@ class ContextDict(MutableMapping):
         'Return root context (highest level ancestor)'
  
          
-        return (path_to_root if self.parent is None else str().join([self.parent.return_path_to_root(), "['", self.parentkey,"']", path_to_root]))
+        if self._path is None :
+            self._path = "" if self.parent is None else str().join([self.parent.return_path_to_root(), "['", self.parentkey,"']"])
+        return self._path + path_to_root
                
         
+    def freeze(self):
+        'Return an immutable, compact snapshot of this context and everything under it'
+        index = {}
+        frozen = FrozenContextDict._build(self, (), index)
+        for key in index:
+            index[key] = tuple(index[key])
+        return frozen
+
     @property
     def root(self):
         'Return root context (highest level ancestor)'
@@ -149,19 +195,13 @@ class ContextDict(MutableMapping):
         return m[key]
 
     def __setitem__(self, key, value):
-        if self.enable_nonlocal:
-            for m in self.maps:
-                if key in m:
-                    m[key] = value
-                    return
+        if key in self.map:
+            self._unindex(key, self.map[key])
         self.map[key] = value
+        self._index(key, value)
 
     def __delitem__(self, key):
-        if self.enable_nonlocal:
-            for m in self.maps:
-                if key in m:
-                    del m[key]
-                    return
+        self._unindex(key, self.map[key])
         del self.map[key]
 
     def __len__(self, len=len, sum=sum, imap=imap):
@@ -181,6 +221,86 @@ class ContextDict(MutableMapping):
         return str(self.map).replace("{","\n{\n").replace( ",",",\n").replace( "}",",\n}")
 
 
+class FrozenContextDict(Mapping):
+    ''' Immutable snapshot of a ContextDict tree, made by ContextDict.freeze()
+
+    Nodes carry only their own dictionary and their path from the top of the
+    snapshot, with one key index shared by the whole tree, so snapshots are
+    small and pickle quickly (eg to send to worker processes).
+
+    f = c.freeze()
+    f['x']                      Value in this context
+    f.lookup(('d', 'x'))        Value at a path below this context
+    f.lookup("['d']['x']")      Same, with a path as given by find_key_paths
+    f.find_key_refs('x', True)  All contexts under f holding 'x'
+    '''
+    __slots__ = ('_map', '_path', '_index')
+
+    def __init__(self, map, path, index):
+        self._map = map
+        self._path = path
+        self._index = index
+
+    @classmethod
+    def _build(cls, context, path, index):
+        map = {}
+        for key, value in context.map.items():
+            if isinstance(value, ContextDict) and value.parent is context:
+                value = cls._build(value, path + (key,), index)
+            map[key] = value
+            index.setdefault(key, []).append(path)
+        return cls(map, path, index)
+
+    def __reduce__(self):
+        return (self.__class__, (self._map, self._path, self._index))
+
+    def lookup(self, path):
+        'Return the value at path, a sequence of keys or a string like "[\'a\'][\'b\']"'
+        if isinstance(path, six.string_types):
+            path = path[2:-2].split("']['") if path else ()
+        value = self
+        for key in path:
+            value = value[key]
+        return value
+
+    def find_key_refs(self, key, sublevels = False):
+        # returns list of all the contexts with the key present
+        depth = len(self._path)
+        return [self.lookup(owner[depth:]) for owner in self._index.get(key, ())
+                if owner[:depth] == self._path and (sublevels or len(owner) == depth)]
+
+    def find_key_value(self, key, sublevels = False):
+        keyrefs = self.find_key_refs(key, sublevels)
+        if len(keyrefs) > 1 :
+            raise Exception("Warning - more than one reference")
+        return keyrefs[0][key]
+
+    def find_key_paths(self, key):
+        # returns the paths from the top of the snapshot to every occurence of key under this context
+        return [ref.return_path_to_root("['{}']".format(key)) for ref in self.find_key_refs(key, True)]
+
+    def return_path_to_root(self, path_to_root = ""):
+        return str().join("['{}']".format(key) for key in self._path) + path_to_root
+
+    def __getitem__(self, key):
+        return self._map[key]
+
+    def __len__(self):
+        return len(self._map)
+
+    def __iter__(self):
+        return iter(self._map)
+
+    def __contains__(self, key):
+        return key in self._map
+
+    def __repr__(self):
+        return repr(self._map)
+
+    def __str__(self):
+        return str(self._map).replace("{","\n{\n").replace( ",",",\n").replace( "}",",\n}")
+
+
 if __name__ == '__main__':
     
     
@@ -7,6 +7,10 @@ from .ContextDict import ContextDict
 
 # Import the xmlimporter\parser
 from xml.dom import minidom
+try:
+    import xml.etree.cElementTree as ElementTree
+except ImportError:
+    import xml.etree.ElementTree as ElementTree
 
 # This dictionary lists the 'simple types' that are currently supported
 SimpleVarTypeDict = {
@@ -94,6 +98,92 @@ def findContainerWithNameTag(XMLDomNode,ContainerName, AllowMultipleNames = Fals
         
     return ReturnObject;
 
+def buildNameIndex(XMLDomNode) :
+    '''
+    buildNameIndex:
+
+    Makes an index of all the containers in the XML, in a single pass.
+    Returns a dictionary mapping the text of each <Name> node to the list
+    of its parent nodes (ie the containers findContainerWithNameTag finds),
+    in document order.
+    '''
+    NameIndex = dict()
+    for NameNode in XMLDomNode.getElementsByTagName("Name") :
+        NameIndex.setdefault(getNodeText(NameNode), list()).append(NameNode.parentNode)
+    return NameIndex
+
+
+def parseLVDataXML_StreamValues(XMLSource, VariableNames) :
+    '''
+    parseLVDataXML_StreamValues:
+
+    Streams through the XML (a filename or file object) with iterparse and
+    returns a dictionary of the values of the variables in VariableNames,
+    in the same form parseLVDataXML_ReturnValue gives them. Variables that
+    are not in the XML are missing from the dictionary.
+
+    Only the wanted variables are ever held in memory - everything else is
+    thrown away as soon as it has been read - and the parse stops as soon
+    as all the variables have been found. Relies on <Name> being the first
+    child of each variable, as LabVIEW writes it. If a name appears more
+    than once, the first variable with it is used. Tags are matched without
+    their namespace (LabVIEW writes xmlns="http://www.ni.com/LVData").
+    '''
+    Wanted = set(VariableNames)
+    Values = dict()
+    Stack = list()
+    Capturing = dict()
+    for Event, Element in ElementTree.iterparse(XMLSource, events=('start', 'end')) :
+        if Event == 'start' :
+            # drop the namespace ElementTree puts on every tag, so the tags
+            # compare, and any subtree kept is written, as minidom sees them
+            Element.tag = Element.tag.rpartition('}')[2]
+            Stack.append(Element)
+            continue
+
+        Stack.pop()
+        Parent = Stack[-1] if Stack else None
+        if Element.tag == 'Name' :
+            Name = Element.text or ''
+            if Name in Wanted and Name not in Values and Parent is not None \
+                    and id(Parent) not in Capturing :
+                Capturing[id(Parent)] = Name
+            continue
+
+        Name = Capturing.pop(id(Element), None)
+        if Name is not None and Element.tag == 'Array' :
+            # arrays can be big, convert them straight from the element
+            Dimsizes = [int(Child.text) for Child in Element if Child.tag == 'Dimsize']
+            Elements = [Child for Child in Element if Child.tag in SimpleVarTypeDict]
+            Texts = [Child.findtext('Val') or '' for Child in Elements]
+            TypeName = Elements[0].tag if Elements else None
+            Values[Name] = _ArrayFromValTexts(TypeName, Texts, Dimsizes)
+        elif Name is not None :
+            # hand the small subtree to the DOM parser, so values come back
+            # exactly as the minidom based functions return them
+            Node = minidom.parseString(ElementTree.tostring(Element)).documentElement
+            Values[Name] = parseLVDataXML(Node)[1]
+
+        if Capturing :
+            # still inside a wanted variable, keep its children
+            continue
+        if Wanted.issubset(Values) :
+            break
+        if Parent is not None and (Element.tag in SimpleVarTypeDict or \
+                Element.tag in ContainerVarTypeDict or Element.tag == 'Array') :
+            Parent.remove(Element)
+        Element.clear()
+    return Values
+
+
+def _isDescendant(XMLDomNode, AncestorNode) :
+    # True if XMLDomNode is AncestorNode or lies within it
+    while XMLDomNode is not None :
+        if XMLDomNode is AncestorNode :
+            return True
+        XMLDomNode = XMLDomNode.parentNode
+    return False
+
 #------------------------------------------------------
 
 # Returns the text inside a XML node.
@@ -215,36 +305,51 @@ def _CreateNewContainerDict(LVData_XMLDomNode) :
        
 
 # Creates and parses np array 
-# ** Note will only work for 1D arrays of simple variables ATM
+# ** Note will only work for arrays of simple variables ATM
 def _CreateNewSimpleArray( LVData_XMLDomNode) :
 
     # Find the name of the new level
     #   (want to change this from the datatype used in xml)
     local_NewEntryName = LVData_XMLDomNode.nodeName
+    local_Dimsizes = list()
+    local_TypeName = None
+    local_Texts = list()
+
+    # Collect the sizes and the text of every element in one pass
     for local_childNodes in LVData_XMLDomNode.childNodes :
         if local_childNodes.nodeName == "Name" :
             local_NewEntryName = getNodeText(local_childNodes)
-        if local_childNodes.nodeName == "Dimsize" :
-            local_NewEntryDimsize = int(getNodeText(local_childNodes))        
-    
-    # create new Array
-    local_NewEntryValue    = np.zeros(local_NewEntryDimsize)
-
-    # Start Parsing the new level
-    local_i = 0
-    for local_XMLDomNode in LVData_XMLDomNode.childNodes :         # root is the ElementTree object
+        elif local_childNodes.nodeName == "Dimsize" :
+            local_Dimsizes.append(int(getNodeText(local_childNodes)))
+        elif local_childNodes.nodeName in SimpleVarTypeDict :
+            local_TypeName = local_childNodes.nodeName
+            local_Text = ''
+            for local_ValNode in local_childNodes.childNodes :
+                if local_ValNode.nodeName == "Val" :
+                    local_Text = getNodeText(local_ValNode)
+                    break
+            local_Texts.append(local_Text)
 
-         NewEntryName, NewEntryValue, NewEntryType = parseLVDataXML(local_XMLDomNode)
-                
-         # if we have parsed the variable correctly then input it into the array
-         if  NewEntryType in SimpleVarTypeDict :
-            
-            local_NewEntryValue[local_i] = NewEntryValue
-            local_i = local_i+1
-             
+    return local_NewEntryName, _ArrayFromValTexts(local_TypeName, local_Texts, local_Dimsizes)
 
 
-    return local_NewEntryName,local_NewEntryValue 
+def _ArrayFromValTexts(TypeName, Texts, Dimsizes) :
+    '''
+    Converts the <Val> texts of the elements of a LabVIEW Array, in the order
+    they appear, to a float np array shaped by the Dimsize entries (first
+    Dimsize outermost). Missing elements are left as zero.
+    '''
+    Shape = tuple(Dimsizes)
+    Size = int(np.prod(Shape)) if Shape else 0
+    Values = np.zeros(Size)
+    Texts = Texts[:Size]
+    if len(Texts) > 0 :
+        if SimpleVarTypeDict[TypeName] == 'bool' :
+            # as bool(text) in parseLVDataXMLSimpleVar
+            Values[:len(Texts)] = [len(Text) > 0 for Text in Texts]
+        else :
+            Values[:len(Texts)] = np.array(Texts, dtype=float)
+    return Values.reshape(Shape)
 
 
 class LabviewXMLDataLoader():    
@@ -252,18 +357,56 @@ class LabviewXMLDataLoader():
     def __init__(self):
         self.XMLDocNode      = None
         self.LVDataDict      = None #ContextDict()
+        self.NameIndex       = None
+        self.LVValues        = None
 
     def loadXMLDataFile(self,filename) :        
         filename = filename
         #sys.stdout.write("Loading LabviewXML...")
         self.XMLDocNode = minidom.parse(filename)
+        self.NameIndex = buildNameIndex(self.XMLDocNode)
         #sys.stdout.write("Complete\n")
         
     def loadXMLDataString(self,XMLString) : 
         #sys.stdout.write("Loading LabviewXML...")
         self.XMLDocNode = minidom.parse(XMLString)
+        self.NameIndex = buildNameIndex(self.XMLDocNode)
         #sys.stdout.write("Complete\n")
 
+    def streamXMLDataFile(self, filename, VariableNames) :
+        '''
+        Reads only the named variables from the file, without building a DOM.
+        The values are stored in LVValues (a dictionary keyed by name) and returned.
+        '''
+        self.LVValues = parseLVDataXML_StreamValues(filename, VariableNames)
+        return self.LVValues
+
+    def findIndexedContainer(self, ContainerName, ContainerNodeName = None) :
+        '''
+        As findContainerWithNameTag, but looks the name up in the index made
+        when the XML was loaded rather than searching the whole document.
+        ContainerNodeName - optional - only look inside the container with this name
+        '''
+        Candidates = self.NameIndex.get(ContainerName, list())
+        if ContainerNodeName != None :
+            ContainerNode = self.findIndexedContainer(ContainerNodeName)
+            Candidates = [Node for Node in Candidates if _isDescendant(Node, ContainerNode)]
+
+        if len(Candidates) == 0 :
+            raise Exception("No node with this name - '{}'".format(ContainerName))
+        if len(Candidates) > 1 :
+            raise Exception("More than one node with this name - '{}'".format(ContainerName))
+        return Candidates[0]
+
+    def returnValue(self, VariableName, VariableType = None, ContainerNodeName = None) :
+        '''
+        As parseLVDataXML_ReturnValue for the loaded XML, using the name index.
+        VariableType  -   currently does nothing - but could be used as an error check
+        '''
+        Varnode = self.findIndexedContainer(VariableName, ContainerNodeName)
+        OutputName,OutputValue,OutputType = parseLVDataXML(Varnode)
+        return OutputValue
+
     def readDataToChainDictionary(self) :          
         self.LVDataDict = ContextDict()
         #sys.stdout.write("Reading LabviewXML...")
@@ -0,0 +1,118 @@
+# Licensed under a 3-clause BSD style license - see LICENSE.rst
+"""
+Checks that the registered header layouts decode DCIMG headers exactly as
+the original byte-by-byte parsers did.
+"""
+import struct
+
+import pytest
+
+from ..Raw import parse_header, from_bytes, DcimgError
+
+
+def _word(hdr_bytes, index):
+    return from_bytes(hdr_bytes[index:index+4], byteorder='little')
+
+
+def _old_parser(hdr_bytes):
+    """The original decoder for old format headers"""
+    header = {}
+    curr_index = 8 + 4*_word(hdr_bytes, 8)
+    header['nframes'] = _word(hdr_bytes, curr_index)
+    header['filesize'] = _word(hdr_bytes, 48)
+    header['bitdepth'] = 8*_word(hdr_bytes, 156)
+    header['xsize_req'] = _word(hdr_bytes, 164)
+    header['bytes_per_row'] = _word(hdr_bytes, 168)
+    header['xsize'] = int(header['bytes_per_row']/2)
+    header['binning'] = int(4096/header['bytes_per_row'])
+    header['footer_loc'] = _word(hdr_bytes, 192) + _word(hdr_bytes, 40)
+    header['ysize'] = _word(hdr_bytes, 172)
+    header['bytes_per_img'] = _word(hdr_bytes, 176)
+    if header['bytes_per_img'] != header['bytes_per_row']*header['ysize']:
+        raise DcimgError('inconsistent sizes')
+    return header
+
+
+def _new_parser(hdr_bytes):
+    """The original decoder for new format headers"""
+    header = {}
+    header['nframes'] = _word(hdr_bytes, 36)
+    header['filesize'] = _word(hdr_bytes, 48)
+    header['bitdepth'] = int(_word(hdr_bytes, 236) / 2)
+    header['xsize_req'] = _word(hdr_bytes, 184)
+    header['bytes_per_row'] = _word(hdr_bytes, 192)
+    header['xsize'] = int(header['bytes_per_row']/2)
+    header['ysize'] = _word(hdr_bytes, 188)
+    header['bytes_per_img'] = _word(hdr_bytes, 196)
+    if header['bytes_per_img'] != header['bytes_per_row']*header['ysize']:
+        raise DcimgError('inconsistent sizes')
+    header['binning'] = int(_word(hdr_bytes, 791)/16/16)
+    return header
+
+
+def _put(hdr_bytes, index, value):
+    hdr_bytes[index:index+4] = struct.pack('<I', value)
+
+
+def _old_header(nframes, nx, ny, skip_words=7):
+    hdr_bytes = bytearray(232)
+    _put(hdr_bytes, 8, skip_words)
+    _put(hdr_bytes, 8 + 4*skip_words, nframes)
+    _put(hdr_bytes, 40, 100)
+    _put(hdr_bytes, 48, 232 + 2*nx*ny*nframes + 1000)
+    _put(hdr_bytes, 156, 2)
+    _put(hdr_bytes, 164, nx)
+    _put(hdr_bytes, 168, 2*nx)
+    _put(hdr_bytes, 172, ny)
+    _put(hdr_bytes, 176, 2*nx*ny)
+    _put(hdr_bytes, 192, 232 + 2*nx*ny*nframes - 100)
+    return hdr_bytes
+
+
+def _new_header(nframes, nx, ny, binning):
+    hdr_bytes = bytearray(864)
+    _put(hdr_bytes, 8, 0x1000000)
+    _put(hdr_bytes, 36, nframes)
+    _put(hdr_bytes, 48, 864 + (2*nx*ny + 32)*nframes)
+    _put(hdr_bytes, 184, nx)
+    _put(hdr_bytes, 188, ny)
+    _put(hdr_bytes, 192, 2*nx)
+    _put(hdr_bytes, 196, 2*nx*ny)
+    _put(hdr_bytes, 236, 32)
+    _put(hdr_bytes, 791, 256*binning)
+    return hdr_bytes
+
+
+@pytest.mark.parametrize(('nframes', 'nx', 'ny', 'skip_words'),
+                         [(1, 2048, 2048, 7), (250, 1024, 512, 7), (13, 512, 100, 20)])
+def test_old_format_matches_original(nframes, nx, ny, skip_words):
+    hdr_bytes = _old_header(nframes, nx, ny, skip_words)
+    layout, header = parse_header(bytes(hdr_bytes) + bytes(864-232), 'MOSCAM')
+    assert layout.format == 0
+    for name, value in _old_parser(hdr_bytes).items():
+        assert header[name] == value, name
+
+
+@pytest.mark.parametrize(('nframes', 'nx', 'ny', 'binning'),
+                         [(1, 2048, 2048, 1), (1000, 1024, 1024, 2), (7, 512, 300, 4)])
+def test_new_format_matches_original(nframes, nx, ny, binning):
+    hdr_bytes = _new_header(nframes, nx, ny, binning)
+    layout, header = parse_header(bytes(hdr_bytes), 'MOSCAM')
+    assert layout.format == 1
+    for name, value in _new_parser(hdr_bytes).items():
+        assert header[name] == value, name
+
+
+def test_zero_word_falls_through_to_new_format():
+    # a zero at byte 8 makes the old format probe look at words that are
+    # all zero in a new format header. It must not match on 0 == 0*0.
+    hdr_bytes = _new_header(5, 1024, 1024, 2)
+    _put(hdr_bytes, 8, 0)
+    layout, header = parse_header(bytes(hdr_bytes), 'MOSCAM')
+    assert layout.format == 1
+    assert header['nframes'] == 5
+
+
+def test_unrecognised_header():
+    with pytest.raises(DcimgError):
+        parse_header(bytes(bytearray(864)), 'MOSCAM')
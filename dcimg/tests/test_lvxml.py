@@ -0,0 +1,74 @@
+# Licensed under a 3-clause BSD style license - see LICENSE.rst
+"""
+Checks that streaming values out of LabVIEW XML gives the same results as
+the minidom based parser.
+"""
+from xml.dom import minidom
+
+import numpy as np
+import pytest
+
+from ..lvxml.LabviewXMLDataLoader import (parseLVDataXML_ReturnValue,
+                                          parseLVDataXML_StreamValues)
+from ..Raw import Dhead
+
+LVDATA = """<?xml version='1.0' standalone='yes' ?>
+<LVData xmlns="http://www.ni.com/LVData">
+<Version>13.0f2</Version>
+<Cluster>
+<Name>Settings</Name>
+<NumElts>6</NumElts>
+<DBL><Name>Exposure  (secs)</Name><Val>0.50000000000000</Val></DBL>
+<String><Name>Object</Name><Val>M31</Val></String>
+<String><Name>Observer</Name><Val>SPL</Val></String>
+<I32><Name>V Offset</Name><Val>3</Val></I32>
+<I32><Name>H Offset</Name><Val>7</Val></I32>
+<String><Name>Camera Model</Name><Val>C11440-22C</Val></String>
+</Cluster>
+<Array>
+<Name>Gains</Name>
+<Dimsize>2</Dimsize>
+<Dimsize>3</Dimsize>
+<DBL><Name></Name><Val>1</Val></DBL>
+<DBL><Name></Name><Val>2</Val></DBL>
+<DBL><Name></Name><Val>3</Val></DBL>
+<DBL><Name></Name><Val>4.5</Val></DBL>
+<DBL><Name></Name><Val>5</Val></DBL>
+<DBL><Name></Name><Val>6</Val></DBL>
+</Array>
+<Boolean><Name>Cooled</Name><Val>1</Val></Boolean>
+</LVData>
+"""
+
+NAMES = ('Exposure  (secs)', 'Object', 'Observer', 'V Offset', 'H Offset',
+         'Camera Model', 'Settings', 'Gains', 'Cooled')
+
+
+@pytest.fixture
+def lvdata(tmpdir):
+    path = tmpdir.join('run001.xml')
+    path.write(LVDATA)
+    return str(path)
+
+
+def test_stream_matches_dom(lvdata):
+    values = parseLVDataXML_StreamValues(lvdata, NAMES + ('Missing',))
+    assert 'Missing' not in values
+
+    doc = minidom.parse(lvdata)
+    for name in NAMES:
+        expected = parseLVDataXML_ReturnValue(doc, name)
+        if isinstance(expected, np.ndarray):
+            assert np.array_equal(values[name], expected), name
+            assert values[name].shape == expected.shape, name
+        elif hasattr(expected, 'keys'):
+            assert str(values[name]) == str(expected), name
+        else:
+            assert values[name] == expected, name
+
+
+def test_dhead_reads_namespaced_xml(lvdata):
+    head = Dhead(lvdata)
+    assert head.exposeTime == 0.5
+    assert head.user == {'object': 'M31', 'observer': 'SPL', 'voffset': 3, 'hoffset': 7}
+    assert head.instrument == 'MOSCAM'
@@ -0,0 +1,25 @@
+#!/usr/bin/env python
+import argparse
+import dcimg
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Build or update a catalogue of DCIMG runs')
+    parser.add_argument('dirs', nargs='+', help='directories to search for runs')
+    parser.add_argument('--db', '-d', action='store', default='dcimg_catalogue.db',
+                        help='SQLite file holding the catalogue')
+    parser.add_argument('--workers', '-w', action='store', type=int, default=None,
+                        help='number of worker processes (default: number of CPUs)')
+    parser.add_argument('--pattern', '-p', action='store', default='run*.dcimg',
+                        help='pattern matched by the .dcimg files of runs')
+    parser.add_argument('--rescan', '-r', action='store_true',
+                        help='read every run again, even if unchanged')
+    args = parser.parse_args()
+
+    nscanned, nremoved = dcimg.build_catalogue(args.dirs, args.db, workers=args.workers,
+                                               pattern=args.pattern, rescan=args.rescan)
+    print('{}: read {} runs, removed {}'.format(args.db, nscanned, nremoved))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,20 +1,164 @@
 #!/usr/bin/env python
 import tornado.ioloop
+from tornado import gen
 from tornado.web import RequestHandler, Application, url
+from concurrent.futures import ThreadPoolExecutor
+import datetime
 import struct
-import numpy as np
 import io
 import dcimg
 import os
 import glob
+import errno
+import select
+import threading
+import collections
 import pkg_resources
 from lxml import etree
 
 
-class MainHandler(RequestHandler):
+class DdataRegistry(object):
+    """
+    Open dcimg.Ddata objects, shared by every handler in the process.
+
+    Tornado makes a new handler for each request, so runs are kept open here
+    instead. The least recently used run is dropped once more than max_open
+    are open, and a run is reopened if its .dcimg or .xml file has changed
+    size or modification time since it was opened, e.g. because it is still
+    being written. Dropped runs are only dereferenced, never closed, so requests
+    still using them are unaffected.
+    """
+    def __init__(self, max_open=16):
+        self.max_open = max_open
+        self._runs = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _stamp(path):
+        stamp = ()
+        for ext in ('.dcimg', '.xml'):
+            st = os.stat(path + ext)
+            stamp += (st.st_size, st.st_mtime)
+        return stamp
+
+    def get(self, path):
+        """Returns an open dcimg.Ddata for the run at path"""
+        stamp = self._stamp(path)
+        with self._lock:
+            entry = self._runs.pop(path, None)
+            if entry is not None and entry[0] == stamp:
+                self._runs[path] = entry
+                return entry[1]
+
+        # open outside the lock, so other runs can be served meanwhile
+        ddata = dcimg.Ddata(path)
+        with self._lock:
+            self._runs[path] = (stamp, ddata)
+            while len(self._runs) > self.max_open:
+                self._runs.popitem(last=False)
+        return ddata
+
+
+class FrameCache(object):
+    """
+    Encoded frames kept in memory, shared by every handler in the process.
+
+    Entries are keyed by (run path, frame, encoding) and hold the chunks of
+    the response body, which must not be changed once cached. The least
+    recently used entries are dropped to keep the total size within
+    max_bytes, and an entry is ignored if the file stamp it was made with
+    (see DdataRegistry) no longer matches.
+    """
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._frames = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, stamp):
+        """Returns the chunks cached for key with file stamp stamp, or None"""
+        with self._lock:
+            entry = self._frames.pop(key, None)
+            if entry is not None and entry[0] == stamp:
+                self._frames[key] = entry
+                self.hits += 1
+                return entry[1]
+            if entry is not None:
+                self.nbytes -= entry[2]
+            self.misses += 1
+            return None
+
+    def put(self, key, stamp, chunks):
+        """Caches chunks for key, made from the file with stamp stamp"""
+        nbytes = sum(len(chunk) for chunk in chunks)
+        if nbytes > self.max_bytes:
+            return
+        with self._lock:
+            entry = self._frames.pop(key, None)
+            if entry is not None:
+                self.nbytes -= entry[2]
+            self._frames[key] = (stamp, chunks, nbytes)
+            self.nbytes += nbytes
+            while self.nbytes > self.max_bytes:
+                key, entry = self._frames.popitem(last=False)
+                self.nbytes -= entry[2]
+
+    def stats(self):
+        """Returns a dictionary of the cache size and hit counts"""
+        with self._lock:
+            return {'frames': len(self._frames), 'nbytes': self.nbytes,
+                    'hits': self.hits, 'misses': self.misses}
+
+
+def sendfile(out, fd, offset, count, timeout):
+    """
+    Sends count bytes from offset in the file fd down the (non-blocking)
+    socket with descriptor out, with os.sendfile, so the data never enter
+    Python. Blocks the calling thread until done, or raises an IOError if the
+    socket has not been writable for timeout seconds. There is no limit on
+    the total time taken, so a slow client that keeps reading is served in
+    full.
+    """
+    poller = select.poll()
+    poller.register(out, select.POLLOUT)
+    while count:
+        try:
+            nsent = os.sendfile(out, fd, offset, count)
+        except OSError as err:
+            if err.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise
+            if not poller.poll(1000*timeout):
+                raise IOError('sendfile: timed out writing to socket')
+            continue
+        if nsent == 0:
+            raise IOError('sendfile: unexpected end of file')
+        offset += nsent
+        count -= nsent
+
+
+class PoolHandler(RequestHandler):
+    """
+    Base for handlers that hand their disk access to the I/O thread pool
+    """
     def initialize(self, db):
         self.db = db
 
+    def run_blocking(self, func, *args):
+        """
+        Runs func(*args) in the I/O thread pool, so disk reads do not hold up
+        the IOLoop. Returns a future that fails with gen.TimeoutError if func
+        has not finished within the request timeout. func keeps its thread
+        until it finishes regardless.
+        """
+        future = self.db['executor'].submit(func, *args)
+        return gen.with_timeout(datetime.timedelta(seconds=self.db['timeout']), future)
+
+
+class MainHandler(PoolHandler):
+
+    @gen.coroutine
     def get(self, path):
         print(path)
         try:
@@ -22,49 +166,138 @@ class MainHandler(RequestHandler):
         except:
             raise tornado.web.HTTPError(400)
         if action == "dir":
-            self.list_dir(self.db['dir'], path)
+            try:
+                listing = yield self.run_blocking(self.list_dir, self.db['dir'], path)
+            except gen.TimeoutError:
+                print('{}: request timed out'.format(path))
+                raise tornado.web.HTTPError(504)
+            self.write(listing)
+        elif action == "stats":
+            # frame cache statistics, as JSON
+            frames = self.db['frames']
+            self.write(frames.stats() if frames is not None else {})
         else:
             raise tornado.web.HTTPError(400)
 
     def list_dir(self, root, stub):
+        # runs in the I/O thread pool, so returns the listing to write
         path = os.path.abspath(os.path.join(root, stub, "*.dcimg"))
         files = [os.path.splitext(
                     os.path.basename(file))[0] for file in glob.glob(path)]
-        self.write("\n".join(files))
+        return "\n".join(files)
 
 
-class RunHandler(RequestHandler):
+class RunHandler(PoolHandler):
 
     def initialize(self, db):
-        self.db = db
+        super(RunHandler, self).initialize(db)
         self.currRun = None
         self.dcimg = None
 
+    @gen.coroutine
     def get(self, run_id):
         try:
             action = self.get_argument('action')
             if action == "get_xml":
+                xml_bytes = yield self.run_blocking(self.get_xml, run_id)
                 self.set_header("Content-Type", 'application/xml; charset="utf-8"')
-                self.get_xml(run_id)
+                self.write(xml_bytes)
             elif action == "get_frame":
-                try:
-                    frame_id = self.get_argument('frame')
-                    self.get_frame(run_id, int(frame_id))
-                except Exception as err:
-                    print(err)
-                    raise tornado.web.HTTPError(400)
+                frame_id = int(self.get_argument('frame'))
+                if self.db['frames'] is not None:
+                    chunks = yield self.get_cached_frame(run_id, frame_id)
+                    yield self.write_frame(*chunks)
+                elif self.db['sendfile'] is not None:
+                    hdr_bytes = yield self.run_blocking(self.get_frame_header, run_id, frame_id)
+                    yield self.sendfile_frame(hdr_bytes, frame_id)
+                else:
+                    hdr_bytes, im_bytes = yield self.run_blocking(self.get_frame, run_id, frame_id)
+                    yield self.write_frame(hdr_bytes, im_bytes)
             else:
                 raise tornado.web.HTTPError(400)
+        except gen.TimeoutError:
+            print('{}: request timed out'.format(run_id))
+            raise tornado.web.HTTPError(504)
         except Exception as err:
             print(err)
             raise tornado.web.HTTPError(400)
 
+    @gen.coroutine
+    def get_cached_frame(self, run_id, frame_id):
+        """
+        Returns the header and data bytes of a frame from the frame cache,
+        reading the frame with get_frame and caching it if it is not there.
+        """
+        path = os.path.join(self.db['dir'], run_id)
+        key = (path, frame_id, 'ucm')
+        # stat the files in the I/O pool too, they may be on a slow disk
+        stamp = yield self.run_blocking(DdataRegistry._stamp, path)
+        chunks = self.db['frames'].get(key, stamp)
+        if chunks is None:
+            chunks = yield self.run_blocking(self.get_frame, run_id, frame_id)
+            self.db['frames'].put(key, stamp, chunks)
+        raise gen.Return(chunks)
+
+    @gen.coroutine
+    def write_frame(self, *chunks):
+        """
+        Sends chunks (bytes-like objects) as the body of a frame response.
+
+        They are passed to the connection as memoryviews once the headers
+        have gone, rather than through self.write, which would copy them into
+        its buffer and join them into one string.
+        """
+        self.set_header("Content-type",  "image/data")
+        self.set_header('Content-length', sum(len(chunk) for chunk in chunks))
+        yield self.flush()
+        for chunk in chunks:
+            yield self.request.connection.write(memoryview(chunk))
+
+    @gen.coroutine
+    def sendfile_frame(self, hdr_bytes, frame_id):
+        """
+        Sends the frame header, then has the kernel copy the frame straight
+        from the .dcimg file to the socket. The stream is taken over from
+        tornado to do this, so the connection is closed afterwards.
+
+        The copy runs in its own thread pool, so slow clients cannot hold up
+        disk reads. It is not subject to the request timeout: the socket
+        must not be closed while the copy is still using it, so this waits
+        for the copy to finish, which it does once it is done or the client
+        has stalled for the timeout. The copy is given its own duplicate of
+        the socket descriptor, and the IOLoop stops watching the socket, so
+        the descriptor stays valid, and is not reused for another
+        connection, until the copy has finished, even if the client hangs up.
+
+        Once the stream has been taken over there is no way to report an
+        error to the client, so errors are printed and the connection closed.
+        """
+        offset = self.dcimg.frame_offset(1+frame_id)
+        self.set_header("Content-type",  "image/data")
+        self.set_header('Content-length', len(hdr_bytes)+self.dcimg.framesize)
+        self.set_header('Connection', 'close')
+        yield self.flush()
+        stream = self.detach()
+        out = None
+        try:
+            yield stream.write(memoryview(hdr_bytes))
+            stream.io_loop.remove_handler(stream.socket)
+            out = os.dup(stream.socket.fileno())
+            yield self.db['sendfile'].submit(sendfile, out, self.dcimg.fileno(),
+                                             offset, self.dcimg.framesize, self.db['timeout'])
+        except Exception as err:
+            print('{}: frame {} not sent: {}'.format(self.currRun, frame_id, err))
+        finally:
+            if out is not None:
+                os.close(out)
+            stream.close()
+
     def load_Ddata(self, run_id):
         # if this is already open and correct, do nothing
         if self.currRun == run_id and self.dcimg is not None:
             return
         self.currRun = run_id
-        self.dcimg = dcimg.Ddata(run_id)
+        self.dcimg = self.db['runs'].get(run_id)
 
     def get_xml(self, run_id):
         # load template from data
@@ -106,12 +339,26 @@ class RunHandler(RequestHandler):
         # write out using BytesIO
         out_xml = io.BytesIO()
         xml.write(out_xml)
-        self.write(out_xml.getvalue())
+        return out_xml.getvalue()
 
     def get_frame(self, run_id, frame_id):
         """
         read in frame from DCIMG file using dcimg module
-        send bytes back in a format that the UCAM software is expecting
+
+        returns the header bytes from get_frame_header and the data bytes
+        """
+        hdr_bytes = self.get_frame_header(run_id, frame_id)
+
+        # IMAGE DATA
+        # the frame is stored on disk as little-endian 16 bit ints, just as
+        # the client wants it, so the bytes are sent as they are
+        im_bytes = self.dcimg.read_raw(1+frame_id)
+        return hdr_bytes, im_bytes
+
+    def get_frame_header(self, run_id, frame_id):
+        """
+        make the header for a frame from the DCIMG file using dcimg module
+        the bytes are sent back in a format that the UCAM software is expecting
         this is a set of header words, followed by the data in 16bit format
 
         data is little-endian
@@ -139,6 +386,9 @@ class RunHandler(RequestHandler):
         Bit 1: Stop Flag -> 0 or 1 for application completed full observation, 1 for stopped early
         Bit 0: Last Frame flag -> 0 or 1 for not last frame/last frame
 
+        This runs in the I/O thread pool, so returns the header bytes for
+        the caller to write rather than writing them itself.
+
         Args:
             run_id: int
             frame_id: int
@@ -146,8 +396,6 @@ class RunHandler(RequestHandler):
         # create a dcimg.Ddata object, if necessary
         self.load_Ddata(os.path.join(self.db['dir'], run_id))
 
-        self.dcimg.set(1+frame_id)
-
         # start with array of 32 NULL bytes
         hdr_bytes = bytearray(32)
 
@@ -175,10 +423,7 @@ class RunHandler(RequestHandler):
         # TIMESTAMP
         # bytes 12-15 are timestamp, number of seconds
         # bytes 16-19 are timestamp, number of nanoseconds / 100
-        if self.dcimg.format == 1:
-            timestamp = self.dcimg.time().value
-        else:
-            timestamp = self.dcimg.timestamps[1+frame_id].value
+        timestamp = self.dcimg.unix_times[frame_id]
         nsecs = int(timestamp)
         nnsecs = int(1e7 * (timestamp-int(timestamp)))
         hdr_bytes[12:16] = struct.pack('<I', nsecs)
@@ -188,20 +433,7 @@ class RunHandler(RequestHandler):
         GPS_STATUS = 0x04  # GPS has synced
         # unsigned short, little endian
         hdr_bytes[24:26] = struct.pack('<H', GPS_STATUS)
-
-        # IMAGE DATA
-        ccd = self.dcimg()
-        if isinstance(ccd, np.ndarray):
-            im = ccd.astype('<u2')
-        else:
-            im = ccd[0].data.astype('<u2')
-        im_bytes = bytearray(im.tobytes())
-
-        # write the stuff
-        self.set_header("Content-type",  "image/data")
-        self.set_header('Content-length', len(hdr_bytes)+len(im_bytes))
-        self.write(io.BytesIO(hdr_bytes).getvalue())
-        self.write(io.BytesIO(im_bytes).getvalue())
+        return hdr_bytes
 
 
 def make_app(db):
@@ -213,8 +445,15 @@ def make_app(db):
     ], debug=False)
 
 
-def run_fileserver(dir):
-    db = {'dir': dir}
+def run_fileserver(dir, max_open=16, workers=8, timeout=30., use_sendfile=False, cache_mb=0,
+                   send_workers=16):
+    if use_sendfile and not hasattr(os, 'sendfile'):
+        print('os.sendfile is not available, frames will be read and sent')
+        use_sendfile = False
+    db = {'dir': dir, 'runs': DdataRegistry(max_open),
+          'executor': ThreadPoolExecutor(max_workers=workers), 'timeout': timeout,
+          'sendfile': ThreadPoolExecutor(max_workers=send_workers) if use_sendfile else None,
+          'frames': FrameCache(cache_mb*1024*1024) if cache_mb > 0 else None}
     app = make_app(db)
     app.listen(8007)
     tornado.ioloop.IOLoop.current().start()
@@ -224,5 +463,20 @@ if __name__ == "__main__":
     usage = """python fileserver.py dir"""
     parser = argparse.ArgumentParser(description="DCIMG FileServer", usage=usage)
     parser.add_argument('dir', help="directory to serve")
+    parser.add_argument('--max-open', type=int, default=16,
+                        help="maximum number of runs to keep open")
+    parser.add_argument('--workers', type=int, default=8,
+                        help="number of threads reading from disk")
+    parser.add_argument('--timeout', type=float, default=30.,
+                        help="seconds before a request is abandoned")
+    parser.add_argument('--sendfile', action='store_true',
+                        help="send frame data straight from disk with os.sendfile; "
+                             "closes the connection after each frame")
+    parser.add_argument('--send-workers', type=int, default=16,
+                        help="number of threads sending frames with --sendfile")
+    parser.add_argument('--cache-mb', type=int, default=0,
+                        help="megabytes of memory for caching frames (0 for no cache); "
+                             "frames not in the cache are read even with --sendfile")
     args = parser.parse_args()
-    run_fileserver(args.dir)
+    run_fileserver(args.dir, args.max_open, args.workers, args.timeout, args.sendfile,
+                   args.cache_mb, args.send_workers)